@@ -3,142 +3,229 @@
 # MIT, see LICENSE for details
 # https://github.com/Jelmerro/NoLQR for updates
 
+import struct
+import sys
+import zlib
+
 from . import constants, util
 
 
+def plan(str_in, error_level="M"):
+    """ Plans the mode and version without encoding the input
+
+    Oversized input is rejected right away,
+    as every character needs at least as many bits as a numeric one,
+    and otherwise when the lower bound of util.minimum_bits doesn't fit.
+    Numeric input and input that is all kanji (see util.kanji_values)
+    are looked up directly in the capacity index,
+    other input is split in segments using util.best_segments.
+    Input that isn't a str (see util.read_input) is a single binary segment.
+    No data is encoded and no matrix is built,
+    so this is a cheap way to check if (and how) the input fits.
+    Returns a dict with the mode, segments, version, width,
+    the number of data bits and the remaining capacity in bits.
+    """
+    if error_level.upper() not in list("LMQH"):
+        raise ValueError("Invalid error level, use L, M (default), Q or H")
+    error_level = error_level.upper()
+    str_in = util.read_input(str_in)
+    if not isinstance(str_in, str):
+        segments = [["binary", str_in]]
+        version = util.version("binary", len(str_in), error_level)
+        bits = util.total_bits(version, "binary", len(str_in))
+    elif len(str_in) > util.CHARACTER_CAPACITIES["numeric"][error_level][-1]:
+        raise util.data_too_big(error_level)
+    elif str_in.isascii() and str_in.isdigit():
+        segments = [["numeric", str_in]]
+        version = util.version("numeric", len(str_in), error_level)
+        bits = util.total_bits(version, "numeric", len(str_in))
+    elif str_in and util.kanji_values(str_in) is not None:
+        segments = [["kanji", str_in]]
+        version = util.version("kanji", len(str_in), error_level)
+        bits = util.total_bits(version, "kanji", len(str_in))
+    elif util.minimum_bits(str_in) > util.BIT_CAPACITIES[error_level][-1]:
+        raise util.data_too_big(error_level)
+    else:
+        segments, version, bits = util.best_segments(str_in, error_level)
+    if len(segments) == 1:
+        mode = segments[0][0]
+    else:
+        mode = "mixed"
+    return {
+        "mode": mode,
+        "segments": segments,
+        "version": version,
+        "width": util.width(version),
+        "bits": bits,
+        "remaining": constants.VERSIONS[version][error_level] - bits
+    }
+
+
 class QRCode():
 
-    def __init__(self, str_in, error_level="M"):
+    def __init__(self, str_in, error_level="M", mask=None,
+                 mask_policy="full", mask_executor=None):
         """ Init for QRCode
 
-        Calls all methods (steps) required to generate a QR code.
-        After all steps, the QR code will be stored as a data matrix.
+        Only checks the arguments, no work is done yet.
+        The input is a str, or a bytes-like object or path for binary data,
+        which is encoded straight from the buffer (see util.read_input).
+        The QR code is generated in stages, each done on first access:
+        - plan, picks the modes and version (see the plan function)
+        - codewords, encodes and pads the data (see generate_codewords)
+        - data, adds the error correction (see generate_data)
+        - placement, puts the data in a matrix (see generate_data_matrix)
+        - masking, picks the mask (see apply_mask_and_finish_format)
+        This means that the version, mode and width are cheap to get,
+        and the matrix is only generated when it's actually needed.
+        Errors about the size of the data are raised by the plan stage.
+        After all stages, the QR code will be stored as bit-packed rows,
+        see the rows property (or matrix for a list of lists).
         To generate an output from the matrix,
         call any method prefixed with "out_".
+        The mask (0 to 7) can be forced, otherwise the mask policy is used,
+        see apply_mask_and_finish_format for the available policies.
+        For large versions, the masks can be scored in parallel,
+        by providing an executor (from concurrent.futures) as mask_executor.
         """
         if error_level.upper() not in list("LMQH"):
             raise ValueError("Invalid error level, use L, M (default), Q or H")
+        if mask is not None and (
+                not isinstance(mask, int) or isinstance(mask, bool)
+                or mask not in range(0, 8)):
+            raise ValueError("Invalid mask, use 0 to 7 or None (default)")
+        if mask_policy not in ["full", "bound", "fast"]:
+            raise ValueError(
+                "Invalid mask policy, use full (default), bound or fast")
+        self.str_in = util.read_input(str_in)
         self.err_lvl = error_level.upper()
-        self.generate_data(str_in)
-        self.static_matrix = []
-        for i in range(0, self.width):
-            self.static_matrix.append([])
-            for _ in range(0, self.width):
-                self.static_matrix[i].append(None)
-        self.add_finder_patterns()
-        self.add_alignment_patterns()
-        self.add_timer_patterns()
-        self.static_matrix[self.width-8][8] = 1
-        self.add_version_information()
-        self.generate_data_matrix()
-        self.merge_matrixes()
-        self.apply_mask_and_finish_format()
-
-    def encode_input(self, str_in):
+        self.mask_policy = mask_policy
+        self.mask_executor = mask_executor
+        self._plan = None
+        self._codewords = None
+        self._data = None
+        self._function_rows = None
+        self._static_rows = None
+        self._data_rows = None
+        self._rows = None
+        self._mask = mask
+        self._mask_scores = None
+        self._buffers = {}
+
+    @property
+    def plan(self):
+        """ The plan of the QR code, see the plan function """
+        if self._plan is None:
+            self._plan = plan(self.str_in, self.err_lvl)
+        return self._plan
+
+    @property
+    def mode(self):
+        """ The encoding mode (or mixed when there are multiple segments) """
+        return self.plan["mode"]
+
+    @property
+    def segments(self):
+        """ The segments as a list of [mode, text] """
+        return self.plan["segments"]
+
+    @property
+    def version(self):
+        """ The version of the QR code (1 to 40) """
+        return self.plan["version"]
+
+    @property
+    def width(self):
+        """ The width (and height) of the QR code in modules """
+        return self.plan["width"]
+
+    @property
+    def codewords(self):
+        """ The data codewords as bytes, see generate_codewords """
+        if self._codewords is None:
+            self.generate_codewords()
+        return self._codewords
+
+    @property
+    def data(self):
+        """ The data and error codewords as bytes, see generate_data """
+        if self._data is None:
+            self.generate_data()
+        return self._data
+
+    def encode_input(self):
         """ Encodes the input string using different modes
 
-        Depending on the result of util.best_mode,
-        The input string is encoded with either:
+        The input is split into segments by plan,
+        which also picks the version that can hold them.
+        Each segment is encoded with either:
         numeric, alphanumeric, binary or kanji.
         Each of these modes has a different way to encode the data,
-        and all of them are implemented below.
+        and all of them are implemented in util.encode_segments.
         The mode indicator and the character count indicator,
-        are added before data, to form the data string.
+        are added before the data of each segment, to form the data bits.
+        The result is returned as a util.BitBuffer.
         """
-        out = ""
-        data_length = 0
-        if self.mode == "numeric":
-            for group in [str_in[i:i+3] for i in range(0, len(str_in), 3)]:
-                if len(group) == 3:
-                    out += "{:010b}".format(int(group))
-                if len(group) == 2:
-                    out += "{:07b}".format(int(group))
-                if len(group) == 1:
-                    out += "{:04b}".format(int(group))
-                data_length += len(group)
-        if self.mode == "alphanumeric":
-            alpha_codes = []
-            for group in [str_in[i:i+2] for i in range(0, len(str_in), 2)]:
-                for character in group:
-                    alpha_codes.append(constants.ALPHA_TABLE[character])
-            for i in range(0, len(alpha_codes), 2):
-                if i + 1 < len(alpha_codes):
-                    number = alpha_codes[i] * 45 + alpha_codes[i + 1]
-                    out += "{:011b}".format(number)
-                    data_length += 2
-                else:
-                    out += "{:06b}".format(alpha_codes[i])
-                    data_length += 1
-        if self.mode == "binary":
-            for character in str_in.encode(constants.ENCODING):
-                out += "{:08b}".format(character)
-                data_length += 1
-        if self.mode == "kanji":
-            characters = []
-            for item in str_in:
-                characters.append(item.encode("shift-jis"))
-            bytes = ""
-            for character in characters:
-                if len(character.hex()) == 4:
-                    bytes += character.hex()
-                else:
-                    # when mixing other alphabets with kanji:
-                    # binary encoding should be used instead of kanji
-                    # otherwise data will be lost
-                    self.mode = "binary"
-                    return self.encode_input(str_in)
-            for group in [bytes[i:i+4] for i in range(0, len(bytes), 4)]:
-                hex_code = int(group, 16)
-                subtractor = ""
-                if hex_code > int("8140", 16) and hex_code < int("9ffc", 16):
-                    subtractor = "8140"
-                elif hex_code > int("e040", 16) and hex_code < int("ebbf", 16):
-                    subtractor = "c140"
-                else:
-                    # when containing unsupported:
-                    # binary encoding should be used instead of kanji
-                    # otherwise data will be lost
-                    self.mode = "binary"
-                    return self.encode_input(str_in)
-                hex_code = "{:04x}".format(hex_code - int(subtractor, 16))
-                sig_bit = int(hex_code[:2], 16)
-                ins_bit = int(hex_code[2:], 16)
-                hex_code = (sig_bit * int("c0", 16)) + ins_bit
-                out += "{:013b}".format(hex_code)
-                data_length += 1
-        self.version = util.version(self.mode, data_length, self.err_lvl)
-        return "{}{}{}".format(
-            constants.MODES[self.mode]["mode_indicator"],
-            util.character_count_indicator(
-                self.mode,
-                data_length,
-                self.version),
-            out)
-
-    def generate_data(self, str_in):
-        """ Generates the data from the input string
-
-        First picks the best mode and calls encode_input.
+        return util.encode_segments(self.segments, self.version)
+
+    def generate_codewords(self):
+        """ Generates the data codewords from the input string
+
+        First encodes the input with encode_input,
+        using the modes and version from the plan.
         After that, zeros are padded as explained in util.pad_zeros.
-        Next the data is split in codewords (each containing 8 bits).
-        These are used to generate the data blocks and error blocks.
+        The result is stored as bytes, each byte is a codeword.
+        """
+        max_bytes = constants.VERSIONS[self.version][self.err_lvl]
+        data = util.pad_zeros(self.encode_input(), max_bytes)
+        self._codewords = data.to_bytes()
+
+    def generate_data(self):
+        """ Generates the data from the codewords
+
+        The codewords are used to generate the data blocks and error blocks.
         The result will be interleaved,
         and some remainer bits are added.
         The amount is always between 0 and 8,
         so 8 are added (overflow bits won't be added anyway).
         """
-        self.mode = util.best_mode(str_in)
-        data = self.encode_input(str_in)
-        self.width = util.width(self.version)
-        max_bytes = constants.VERSIONS[self.version][self.err_lvl]
-        data = util.pad_zeros(data, max_bytes)
-        codewords = [data[i:i+8] for i in range(0, len(data), 8)]
         info = constants.ERROR_CORRECTION_BLOCKS[self.version][self.err_lvl]
-        data_blocks, error_blocks = util.generate_blocks(codewords, info)
+        data_blocks, error_blocks = util.generate_blocks(self.codewords, info)
         result = util.interleave_codewords(data_blocks, error_blocks)
-        self.data = result + "0"*8
+        self._data = result + bytes(1)
+
+    def generate_static_matrix(self):
+        """ Generates the static matrix
 
-    def add_finder_patterns(self):
+        The static matrix contains all the patterns,
+        which only depend on the version of the qr code:
+        finder, alignment and timer patterns,
+        the dark module and the version information.
+        These are added once per version,
+        after which the result is stored in util.STATIC_TEMPLATES.
+        A template consists of two tuples of bit-packed rows,
+        one with the function modules (see function_rows),
+        and one with the dark modules of the patterns.
+        Any next QR code of the same version reuses the template.
+        """
+        template = util.STATIC_TEMPLATES.get(self.version)
+        if template is None:
+            matrix = []
+            for i in range(0, self.width):
+                matrix.append([None] * self.width)
+            self.add_finder_patterns(matrix)
+            self.add_alignment_patterns(matrix)
+            self.add_timer_patterns(matrix)
+            matrix[self.width-8][8] = 1
+            self.add_version_information(matrix)
+            template = (
+                util.pack_rows([
+                    [value is not None for value in row] for row in matrix]),
+                util.pack_rows(matrix))
+            util.STATIC_TEMPLATES[self.version] = template
+        self._function_rows, self._static_rows = template
+
+    def add_finder_patterns(self, matrix):
         """ Adds the finder patterns to the matrix
 
         In the top-left, top-right and bottom-left corner,
@@ -152,25 +239,25 @@ class QRCode():
         """
         for y in range(0, 9):
             for x in range(0, 9):
-                self.static_matrix[y][x] = 0
+                matrix[y][x] = 0
         for y in range(self.width-8, self.width):
             for x in range(0, 9):
-                self.static_matrix[y][x] = 0
+                matrix[y][x] = 0
         for y in range(0, 9):
             for x in range(self.width-8, self.width):
-                self.static_matrix[y][x] = 0
+                matrix[y][x] = 0
         for base_x, base_y in [[0, 0], [self.width-7, 0], [0, self.width-7]]:
             for x in range(base_x, base_x+7):
-                self.static_matrix[base_y][x] = 1
-                self.static_matrix[base_y+6][x] = 1
+                matrix[base_y][x] = 1
+                matrix[base_y+6][x] = 1
             for y in range(base_y, base_y+7):
-                self.static_matrix[y][base_x] = 1
-                self.static_matrix[y][base_x+6] = 1
+                matrix[y][base_x] = 1
+                matrix[y][base_x+6] = 1
             for y in range(base_y+2, base_y+5):
                 for x in range(base_x+2, base_x+5):
-                    self.static_matrix[y][x] = 1
+                    matrix[y][x] = 1
 
-    def add_alignment_patterns(self):
+    def add_alignment_patterns(self, matrix):
         """ Adds the alignment patterns to the matrix
 
         The alignment patterns are added in different locations,
@@ -189,21 +276,21 @@ class QRCode():
         patterns = constants.VERSIONS[self.version]["alignment"]
         for base_x in patterns:
             for base_y in patterns:
-                if not self.static_matrix[base_y][base_x]:
+                if not matrix[base_y][base_x]:
                     for y in range(base_y-2, base_y+3):
                         for x in range(base_x-2, base_x+3):
-                            self.static_matrix[y][x] = 0
+                            matrix[y][x] = 0
                     for y in range(base_y-2, base_y+3):
-                        self.static_matrix[y][base_x-2] = 1
+                        matrix[y][base_x-2] = 1
                     for x in range(base_x-2, base_x+3):
-                        self.static_matrix[base_y-2][x] = 1
+                        matrix[base_y-2][x] = 1
                     for y in range(base_y-2, base_y+3):
-                        self.static_matrix[y][base_x+2] = 1
+                        matrix[y][base_x+2] = 1
                     for x in range(base_x-2, base_x+3):
-                        self.static_matrix[base_y+2][x] = 1
-                    self.static_matrix[base_y][base_x] = 1
+                        matrix[base_y+2][x] = 1
+                    matrix[base_y][base_x] = 1
 
-    def add_timer_patterns(self):
+    def add_timer_patterns(self, matrix):
         """ Adds the timer pattern to the matrix
 
         The timer pattern is a dotted line,
@@ -212,13 +299,13 @@ class QRCode():
         because this dotted line is part of the pattern.
         """
         for x in range(6, self.width-8, 2):
-            self.static_matrix[6][x] = 1
-            self.static_matrix[6][x+1] = 0
+            matrix[6][x] = 1
+            matrix[6][x+1] = 0
         for y in range(6, self.width-8, 2):
-            self.static_matrix[y][6] = 1
-            self.static_matrix[y+1][6] = 0
+            matrix[y][6] = 1
+            matrix[y+1][6] = 0
 
-    def add_version_information(self):
+    def add_version_information(self, matrix):
         """ Adds the version information to the matrix
 
         This is only needed for version 7 and up,
@@ -231,16 +318,16 @@ class QRCode():
             index = 17
             for y in range(0, 6):
                 for x in range(self.width-11, self.width-8):
-                    self.static_matrix[y][x] = int(pattern[index])
+                    matrix[y][x] = int(pattern[index])
                     index -= 1
             index = 17
             for x in range(0, 6):
                 for y in range(self.width-11, self.width-8):
-                    self.static_matrix[y][x] = int(pattern[index])
+                    matrix[y][x] = int(pattern[index])
                     index -= 1
 
-    def generate_data_matrix(self):
-        """ Generates the data matrix
+    def generate_data_positions(self):
+        """ Generates the positions of the data bits
 
         The data is added in a zig-zag pattern,
         starting in the bottom right corner.
@@ -249,16 +336,18 @@ class QRCode():
         and add the data in a zig-zag going down.
         If a reserved bit is found,
         skip it, and add the data bit in the next suitable location.
-        This is done for all the data and the entire matrix,
+        This is done for the entire matrix,
         with one exception for the vertical timing pattern.
         This column is skipped altogether,
         and the zig-zag pattern will continue one bit to the left.
+        The positions only depend on the version,
+        so they are stored in util.DATA_POSITIONS after the first time.
+        Returns a tuple of positions (y * width + x) in placement order.
         """
-        self.data_matrix = []
-        for i in range(0, self.width):
-            self.data_matrix.append([])
-            for _ in range(0, self.width):
-                self.data_matrix[i].append(None)
+        positions = util.DATA_POSITIONS.get(self.version)
+        if positions is not None:
+            return positions
+        positions = []
         for base_x in range(self.width-1, 0, -2):
             for base_y in range(self.width-1, -1, -1):
                 if base_x < 8:
@@ -269,31 +358,90 @@ class QRCode():
                     y = self.width - base_y - 1
                 else:
                     y = base_y
-                if self.data and self.static_matrix[y][x] is None:
-                    self.data_matrix[y][x] = int(self.data[:1])
-                    self.data = self.data[1:]
-                if x > 0 and self.data and self.static_matrix[y][x-1] is None:
-                    self.data_matrix[y][x-1] = int(self.data[:1])
-                    self.data = self.data[1:]
-
-    def merge_matrixes(self):
-        """ Merge the data and the static matrix
-
-        When this method is called,
-        all patterns are in the static matrix,
-        and all data is in the data matrix.
-        This method simply merges the two matrixes,
-        into a single matrix.
+                for column in [x, x-1]:
+                    shift = self.width - 1 - column
+                    if not (self._function_rows[y] >> shift) & 1:
+                        positions.append(y * self.width + column)
+        positions = tuple(positions)
+        util.DATA_POSITIONS[self.version] = positions
+        return positions
+
+    def generate_data_matrix(self):
+        """ Generates the data matrix
+
+        The data bits are placed at the positions,
+        as returned by generate_data_positions.
+        The bytes of the data are converted to a bytes object,
+        with a single 0 or 1 for each bit,
+        so the placement is a single loop over the positions.
+        The result is stored as bit-packed rows, see data_matrix.
+        The static matrix is generated first, as the positions need it.
         """
-        self.matrix = []
-        for i in range(0, self.width):
-            self.matrix.append([])
-            for j in range(0, self.width):
-                self.matrix[i].append(self.static_matrix[i][j])
-        for x in range(0, self.width):
+        self.generate_static_matrix()
+        modules = bytearray(self.width * self.width)
+        bits = "{:0{}b}".format(
+            int.from_bytes(self.data, "big"), len(self.data) * 8)
+        bits = bits.encode().translate(util.BITS_TABLE)
+        for position, bit in zip(self.generate_data_positions(), bits):
+            modules[position] = bit
+        self._data_rows = util.pack_modules(modules, self.width)
+
+    def generate_mask_templates(self):
+        """ Generates the mask patterns and boards for the version
+
+        The masks are only applied to the data modules,
+        so they are stored as bit-packed rows without the function modules.
+        For the scoring of the masks, the rows and columns are also
+        combined into boards (see util.board), for the static matrix,
+        each of the masks and all the modules (the valid bits).
+        The result only depends on the version,
+        so it's stored in util.MASK_TEMPLATES after the first time.
+        """
+        templates = util.MASK_TEMPLATES.get(self.version)
+        if templates is not None:
+            return templates
+        full_row = (1 << self.width) - 1
+        data_modules = [full_row ^ row for row in self._function_rows]
+        masks = []
+        for pattern in util.MASK_PATTERNS:
+            mask = []
             for y in range(0, self.width):
-                if self.matrix[y][x] is None:
-                    self.matrix[y][x] = self.data_matrix[y][x]
+                row = 0
+                for x in range(0, self.width):
+                    row = (row << 1) | pattern(x, y)
+                mask.append(row & data_modules[y])
+            masks.append(tuple(mask))
+        templates = {
+            "masks": masks,
+            "mask_boards": [util.boards(mask, self.width) for mask in masks],
+            "static_boards": util.boards(self._static_rows, self.width),
+            "valid": util.board([full_row] * self.width, self.width)
+        }
+        util.MASK_TEMPLATES[self.version] = templates
+        return templates
+
+    def generate_format_templates(self):
+        """ Generates the format information for each mask
+
+        The format string depends on the error level and the mask,
+        and is added to an empty matrix with util.add_format_info.
+        The result is stored as bit-packed rows and as boards,
+        in util.FORMAT_TEMPLATES after the first time.
+        """
+        key = (self.version, self.err_lvl)
+        templates = util.FORMAT_TEMPLATES.get(key)
+        if templates is not None:
+            return templates
+        templates = []
+        for format_string in constants.FORMAT_STRING[self.err_lvl]:
+            matrix = []
+            for _ in range(0, self.width):
+                matrix.append([0] * self.width)
+            util.add_format_info(matrix, self.width, format_string)
+            rows = util.pack_rows(matrix)
+            templates.append((rows, util.boards(rows, self.width)))
+        util.FORMAT_TEMPLATES[key] = templates
+        return templates
 
     def apply_mask_and_finish_format(self):
         """ Apply mask and finish overall formatting
@@ -301,117 +449,217 @@ class QRCode():
         Each masking pattern is applied separately,
         and the best one is picked.
         This is done by calculating a score,
-        for each of the different mask patterns.
-        There are four penalty rules for that:
-        - Single line with same colored bits (column or row)
-            This gives a penalty for each group of 5 or more.
-            The penalty is 3 for a group of 5,
-            and 1 more for every next same colored bit.
-            This is tested for horizontal and vertical lines.
-        - 2x2 area of same colored bits
-            This gives a penalty for ALL 2x2 groups,
-            even if they are part of another group.
-            Every 2x2 square has a penalty of 3.
-        - Similar bits to a finder pattern (column or row)
-            This gives a penalty for all 10111010000 or 00001011101.
-            Each time these bits are found, add 40 to the penalty.
-            This is tested for horizontal and vertical lines.
-        - A large amount of dark or light bits
-            If the percentage of dark modules is not near 50,
-            add a penalty of 10 for every 5 percent (rounded down).
-            This means, 4.9 percent results in 0, but 5.0 in 10.
-
+        for each of the different mask patterns (see util.penalty).
+        The masks are applied to the rows and columns of the data at once,
+        by using a xor on the boards (see util.board).
+        The format string is added in the process as well,
+        because the penalty rules also apply to the format bits.
         After calculating the score for all different mask patterns,
         the mask pattern with the lowest score is used.
-        The format string was already added in the process,
-        because the penalty rules also apply to the format bits.
+        How the masks are scored depends on the mask policy:
+        - full, all the penalty rules are calculated for every mask
+        - bound, a mask is abandoned once the penalty is too high to win,
+            which results in the same mask as full
+        - fast, only the rows are checked and the finder-like patterns
+            are skipped, which is quicker but might pick a different mask
+        The scores are stored in mask_scores (None if not fully scored),
+        and the picked mask is stored in mask.
+        With a mask executor and a version of at least
+        constants.PARALLEL_MASK_VERSION, all masks are scored in parallel.
+        The bound policy is the same as full in that case,
+        as the masks can't be abandoned based on the other scores.
+        When the mask was provided, no scores are calculated,
+        and once the mask was picked, the scores are kept as they are.
         """
-        matrixes = []
-        scores = []
-        for m in range(0, 8):
-            matrixes.append([])
-            scores.append(0)
-            for i in range(0, self.width):
-                matrixes[m].append([])
-                for j in range(0, self.width):
-                    matrixes[m][i].append(self.matrix[i][j])
-        masks = [
-            lambda x, y: (x + y) % 2 == 0,
-            lambda x, y: y % 2 == 0,
-            lambda x, y: x % 3 == 0,
-            lambda x, y: (x + y) % 3 == 0,
-            lambda x, y: (int(y / 2) + int(x / 3)) % 2 == 0,
-            lambda x, y: (x * y) % 2 + (x * y) % 3 == 0,
-            lambda x, y: ((x * y) % 3 + x * y) % 2 == 0,
-            lambda x, y: ((x * y) % 3 + x + y) % 2 == 0
-        ]
-        for m in range(0, 8):
-            for x in range(0, self.width):
-                for y in range(0, self.width):
-                    if self.data_matrix[y][x] is not None and masks[m](x, y):
-                        matrixes[m][y][x] = (self.data_matrix[y][x]+1) % 2
-            matrixes[m] = util.add_format_info(
-                matrixes[m],
-                self.width,
-                constants.FORMAT_STRING[self.err_lvl][m])
-            for direction in [0, 1]:
-                total_black = 0
-                counter_white = 0
-                counter_black = 0
-                ss1 = ""
-                ss2 = ""
-                for x_or_y1 in range(0, self.width):
-                    for x_or_y2 in range(0, self.width):
-                        if direction:
-                            current_position = matrixes[m][x_or_y1][x_or_y2]
-                        else:
-                            current_position = matrixes[m][x_or_y2][x_or_y1]
-                        if current_position == 1:
-                            counter_white = 0
-                            counter_black += 1
-                            total_black += 1
-                        else:
-                            counter_white += 1
-                            counter_black = 0
-                        if counter_white == 5 or counter_black == 5:
-                            scores[m] += 3
-                        elif counter_white > 5 or counter_black > 5:
-                            scores[m] += 1
-                        if current_position == int("10111010000"[len(ss1)]):
-                            ss1 += str(current_position)
-                            if len(ss1) == 11:
-                                scores[m] += 40
-                                ss1 = ""
-                        else:
-                            ss1 = ""
-                        if current_position == int("00001011101"[len(ss2)]):
-                            ss2 += str(current_position)
-                            if len(ss2) == 11:
-                                scores[m] += 40
-                                ss2 = ""
-                        else:
-                            ss2 = ""
-            for x in range(0, self.width-1):
-                for y in range(0, self.width-1):
-                    if matrixes[m][y+1][x] == 1 and matrixes[m][y+1][x+1] == 1:
-                        if matrixes[m][y][x] == 1 and matrixes[m][y][x+1] == 1:
-                            scores[m] += 3
-                    if matrixes[m][y+1][x] == 0 and matrixes[m][y+1][x+1] == 0:
-                        if matrixes[m][y][x] == 0 and matrixes[m][y][x+1] == 0:
-                            scores[m] += 3
-            percentage = (total_black / (self.width * self.width)) * 100
-            if percentage > 50:
-                scores[m] += int((percentage - 50) / 5) * 10
-            elif percentage < 50:
-                scores[m] += int((50 - percentage) / 5) * 10
-        self.matrix = matrixes[scores.index(min(scores))]
-
-    def out_terminal(self, inverted=True):
+        if self._data_rows is None:
+            self.generate_data_matrix()
+        templates = self.generate_mask_templates()
+        formats = self.generate_format_templates()
+        if self._mask is None:
+            self._mask_scores = [None] * 8
+            fast = self.mask_policy == "fast"
+            data_rows = util.board(self._data_rows, self.width)
+            data_columns = None
+            if not fast:
+                data_columns = util.board(
+                    util.transpose(self._data_rows, self.width), self.width)
+            static_rows, static_columns = templates["static_boards"]
+            candidates = []
+            for m in range(0, 8):
+                mask_rows, mask_columns = templates["mask_boards"][m]
+                format_rows, format_columns = formats[m][1]
+                columns = None
+                if not fast:
+                    columns = static_columns | format_columns | (
+                        data_columns ^ mask_columns)
+                candidates.append((
+                    static_rows | format_rows | (data_rows ^ mask_rows),
+                    columns))
+            parallel = self.mask_executor is not None and \
+                self.version >= constants.PARALLEL_MASK_VERSION
+            if parallel:
+                self._mask_scores = list(self.mask_executor.map(
+                    util.penalty,
+                    [rows for rows, _ in candidates],
+                    [columns for _, columns in candidates],
+                    [templates["valid"]] * 8,
+                    [self.width] * 8))
+                self._mask = self._mask_scores.index(min(self._mask_scores))
+            else:
+                best_score = None
+                for m, (rows, columns) in enumerate(candidates):
+                    limit = None
+                    if self.mask_policy == "bound":
+                        limit = best_score
+                    score = util.penalty(
+                        rows, columns, templates["valid"], self.width, limit)
+                    self._mask_scores[m] = score
+                    if score is not None and (
+                            best_score is None or score < best_score):
+                        best_score = score
+                        self._mask = m
+        elif self._mask_scores is None:
+            self._mask_scores = [None] * 8
+        self._rows = tuple(
+            static | (data ^ mask) | format_info
+            for static, data, mask, format_info in zip(
+                self._static_rows, self._data_rows,
+                templates["masks"][self._mask], formats[self._mask][0]))
+
+    @property
+    def mask(self):
+        """ The mask that was provided or picked for the QR code """
+        if self._mask is None:
+            self.apply_mask_and_finish_format()
+        return self._mask
+
+    @property
+    def mask_scores(self):
+        """ The penalty scores of the masks (None if not fully scored) """
+        if self._mask_scores is None:
+            self.apply_mask_and_finish_format()
+        return self._mask_scores
+
+    @property
+    def rows(self):
+        """ The QR code as a tuple of bit-packed rows
+
+        Each row is a single int, with a bit for each module,
+        the most significant bit being the left-most module (x = 0).
+        A set bit is a dark module.
+        """
+        if self._rows is None:
+            self.apply_mask_and_finish_format()
+        return self._rows
+
+    @property
+    def function_rows(self):
+        """ The function modules as a tuple of bit-packed rows
+
+        Same layout as rows, but a set bit means the module is part of
+        a pattern or the format/version information instead of the data.
+        """
+        if self._function_rows is None:
+            self.generate_static_matrix()
+        return self._function_rows
+
+    def module(self, x, y):
+        """ Returns the module at the x and y position (1 is dark) """
+        return (self.rows[y] >> (self.width - 1 - x)) & 1
+
+    def buffer(self, packed=False):
+        """ The QR code as a read-only memoryview of two dimensions
+
+        Each module is a single byte (1 is dark) in a shape of width by width,
+        so it can be used without copying, for example with numpy.asarray.
+        With packed, each row is packed to bytes instead (see rows_to_bytes),
+        with 8 modules per byte, the most significant bit being the left-most.
+        The shape is then width by the number of bytes per row.
+        The bytes are only made once, and are shared by all views.
+        """
+        if packed not in self._buffers:
+            if packed:
+                data = util.rows_to_bytes(self.rows, self.width)
+            else:
+                data = util.unpack_modules(self.rows, self.width)
+            self._buffers[packed] = data
+        data = self._buffers[packed]
+        return memoryview(data).cast(
+            "B", (self.width, len(data) // self.width))
+
+    @property
+    def matrix(self):
+        """ The QR code as a list of rows, each a list of 0 or 1 """
+        return util.unpack_rows(self.rows, self.width)
+
+    @property
+    def static_matrix(self):
+        """ The function modules as a list of rows
+
+        Each row is a list of 0 or 1 for the function modules,
+        data modules are None.
+        The format information is not part of it.
+        """
+        function_rows = self.function_rows
+        return util.unpack_rows(self._static_rows, self.width, function_rows)
+
+    @property
+    def data_matrix(self):
+        """ The data modules (before masking) as a list of rows
+
+        Each row is a list of 0 or 1 for the data modules,
+        function modules are None.
+        """
+        if self._data_rows is None:
+            self.generate_data_matrix()
+        full_row = (1 << self.width) - 1
+        return util.unpack_rows(
+            self._data_rows, self.width,
+            [full_row ^ row for row in self._function_rows])
+
+    def __getstate__(self):
+        """ Returns the state for pickling
+
+        Only the plan, mask and the rows (packed as bytes) are kept,
+        all the other stages are not needed once the rows are generated.
+        The mask executor can't be pickled, so it's left out as well.
+        Binary input is stored as bytes, as buffers can't be pickled.
+        """
+        rows = None
+        if self._rows is not None:
+            rows = util.rows_to_bytes(self._rows, self.width)
+        plan = self._plan
+        if plan is not None:
+            plan = dict(plan, segments=[
+                [mode, util.input_key(text)]
+                for mode, text in plan["segments"]])
+        return {
+            "str_in": util.input_key(self.str_in),
+            "err_lvl": self.err_lvl,
+            "mask_policy": self.mask_policy,
+            "plan": plan,
+            "mask": self._mask,
+            "mask_scores": self._mask_scores,
+            "rows": rows
+        }
+
+    def __setstate__(self, state):
+        """ Restores the state after unpickling, see __getstate__ """
+        self.__init__(
+            state["str_in"], state["err_lvl"], state["mask"],
+            state["mask_policy"])
+        self._plan = state["plan"]
+        self._mask_scores = state["mask_scores"]
+        if state["rows"] is not None:
+            self._rows = util.rows_from_bytes(state["rows"], self.width)
+
+    def out_terminal(self, inverted=True, stream=None):
         """ Output to terminal
 
         Output the QR Code to the terminal.
-        Simply loops over the matrix two lines at the time,
-        and prints the suitable character (█, ▄, ▀ or a space).
+        Simply loops over the rows two at the time,
+        and picks the suitable character (█, ▄, ▀ or a space).
+        The lines are written at once to the stream (stdout by default).
         """
         if inverted:
             EMPTY = "█"
@@ -423,55 +671,102 @@ class QRCode():
             TOP = "▀"
             BOTTOM = "▄"
             FULL = "█"
-        print(EMPTY*(self.width+4))
+        characters = {
+            ("0", "0"): EMPTY, ("1", "0"): TOP,
+            ("0", "1"): BOTTOM, ("1", "1"): FULL}
+        rows = self.rows + (0,)
+        lines = [EMPTY*(self.width+4) + "\n"]
         for row in range(0, self.width, 2):
-            out = EMPTY*2
-            for p in range(0, self.width):
-                if row+1 == self.width:
-                    if self.matrix[row][p]:
-                        out += TOP
-                    else:
-                        out += EMPTY
-                elif self.matrix[row][p] and self.matrix[row+1][p]:
-                    out += FULL
-                elif self.matrix[row][p]:
-                    out += TOP
-                elif self.matrix[row+1][p]:
-                    out += BOTTOM
-                else:
-                    out += EMPTY
-            out += EMPTY*2
-            print(out)
-        print(EMPTY*(len(self.matrix)+4))
+            top = "{:0{}b}".format(rows[row], self.width)
+            bottom = "{:0{}b}".format(rows[row+1], self.width)
+            lines.append("{}{}{}\n".format(
+                EMPTY*2,
+                "".join(characters[pair] for pair in zip(top, bottom)),
+                EMPTY*2))
+        lines.append(EMPTY*(self.width+4) + "\n")
+        if stream is None:
+            stream = sys.stdout
+        util.write_output(stream, lines, "txt")
 
     def out_svg(self,
-                filename,
+                filename=None,
                 dark="black",
                 light="white",
-                background="white"):
+                background="white",
+                merged=False):
         """ Output as an svg
 
-        Output the QR Code to an svg file.
+        Output the QR Code to an svg file, or to a writable stream instead.
         Loops over the matrix, and makes a rect for each square.
         Also makes a colored background.
         Custom colors and sizes can be provided as arguments.
+        With merged, the dark modules are drawn as a single path instead,
+        with each horizontal run of dark modules merged into one rectangle.
+        Without a filename or stream, the svg is returned as a string.
         """
-        filename = filename.rstrip()
-        if not filename.endswith(".svg"):
-            filename = "{}.svg".format(filename)
+        size = self.width + 4
         rect = '    <rect x="{}" y="{}" height="{}" width="{}" fill="{}" />\n'
-        out = '<?xml version="1.0" encoding="UTF-8" ?>\n'
-        out += '<!-- Generated with NoLQR, QR code generation lighter ' \
-            'than an unladen swallow -->\n'
-        out += '<!-- Visit https://github.com/Jelmerro/NoLQR ' \
-            'for updates and details -->\n'
-        out += '<svg height="{}" width="{}" xmlns="http://www.w3.org/' \
-            '2000/svg" version="1.1">\n'.format(self.width+4, self.width+4)
-        out += rect.format(0, 0, self.width+4, self.width+4, background)
-        for row in range(0, self.width):
-            for col in range(0, self.width):
-                out += rect.format(
-                    2 + row, 2 + col, 1, 1,
-                    dark if self.matrix[col][row] else light)
-        with open(filename, "w") as f:
-            f.write(out + "</svg>")
+        out = [
+            '<?xml version="1.0" encoding="UTF-8" ?>\n',
+            '<!-- Generated with NoLQR, QR code generation lighter '
+            'than an unladen swallow -->\n',
+            '<!-- Visit https://github.com/Jelmerro/NoLQR '
+            'for updates and details -->\n',
+            '<svg height="{}" width="{}" xmlns="http://www.w3.org/'
+            '2000/svg" version="1.1">\n'.format(size, size),
+            rect.format(0, 0, size, size, background)]
+        if merged:
+            if light != background:
+                out.append(rect.format(2, 2, self.width, self.width, light))
+            path = []
+            for y, row in enumerate(self.rows):
+                for x, length in util.dark_runs(row, self.width):
+                    path.append("M{} {}h{}v1h-{}z".format(
+                        2 + x, 2 + y, length, length))
+            out.append('    <path d="{}" fill="{}" />\n'.format(
+                "".join(path), dark))
+        else:
+            matrix = self.matrix
+            for row in range(0, self.width):
+                for col in range(0, self.width):
+                    out.append(rect.format(
+                        2 + row, 2 + col, 1, 1,
+                        dark if matrix[col][row] else light))
+        out.append("</svg>")
+        return util.write_output(filename, out, "svg")
+
+    def out_png(self,
+                filename=None,
+                scale=4,
+                border=2,
+                dark="black",
+                light="white"):
+        """ Output as a png
+
+        Output the QR Code to a png file, or to a writable binary stream.
+        The png has a palette of the light and dark color, and 1 bit per pixel.
+        Each module is scale pixels wide and high,
+        with a light border of border modules around the QR code.
+        Every unique row is only scaled once, and reused for all scale lines.
+        Without a filename or stream, the png is returned as bytes.
+        """
+        size = (self.width + 2 * border) * scale
+        scanlines = {}
+        lines = []
+        blank = util.scaled_row(0, self.width, scale, border) * scale
+        lines.append(blank * border)
+        for row in self.rows:
+            if row not in scanlines:
+                scanlines[row] = util.scaled_row(
+                    row, self.width, scale, border) * scale
+            lines.append(scanlines[row])
+        lines.append(blank * border)
+        header = struct.pack(">IIBBBBB", size, size, 1, 3, 0, 0, 0)
+        palette = bytes(util.color_rgb(light) + util.color_rgb(dark))
+        out = [
+            b"\x89PNG\r\n\x1a\n",
+            util.png_chunk(b"IHDR", header),
+            util.png_chunk(b"PLTE", palette),
+            util.png_chunk(b"IDAT", zlib.compress(b"".join(lines))),
+            util.png_chunk(b"IEND", b"")]
+        return util.write_output(filename, out, "png")
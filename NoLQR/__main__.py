@@ -0,0 +1,195 @@
+# CLI of NoLQR, QR code generation lighter than an unladen swallow
+# Made by Jelmerro, see README.md for more details
+# MIT, see LICENSE for details
+# https://github.com/Jelmerro/NoLQR for updates
+
+import argparse
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+import zipfile
+
+from .bulk import render_many
+
+FORMATS = ["svg", "png"]
+
+
+def read_items(lines, ndjson, on_error):
+    """ Reads the items from the lines of the input, lazily
+
+    The lines are bytes, decoded as utf-8 one by one.
+    Each line is a single input string, or with ndjson, a json object
+    with the "data" and any other options (see bulk.render_chunk).
+    Items without a name are named after the line number.
+    Empty lines are skipped for ndjson, other lines that can't be decoded
+    or aren't a json object with data are passed to on_error with the
+    name and error, then skipped.
+    """
+    for number, line in enumerate(lines, start=1):
+        name = "{:08d}".format(number)
+        try:
+            line = line.rstrip(b"\r\n").decode("utf-8")
+        except UnicodeDecodeError as e:
+            on_error(name, ValueError("Invalid utf-8, {}".format(e)))
+            continue
+        if ndjson:
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                on_error(name, ValueError("Invalid json, {}".format(e)))
+                continue
+            if not isinstance(item, dict) or "data" not in item:
+                on_error(name, ValueError(
+                    "Invalid item, use a json object with data per line"))
+                continue
+        else:
+            item = {"data": line}
+        item.setdefault("name", name)
+        yield item
+
+
+class OutputWriter():
+    """ Writes the outputs to a directory, an archive or stdout
+
+    The type of output depends on the target:
+    "-" for stdout, a file ending with .zip, .tar, .tar.gz or .tgz
+    for an archive, anything else is used as a directory.
+    """
+
+    def __init__(self, target, extension):
+        self.target = target
+        self.extension = extension
+        self.archive = None
+        if target == "-":
+            self.kind = "stdout"
+        elif target.endswith(".zip"):
+            self.kind = "zip"
+            self.archive = zipfile.ZipFile(
+                target, "w", zipfile.ZIP_DEFLATED)
+        elif target.endswith((".tar", ".tar.gz", ".tgz")):
+            self.kind = "tar"
+            mode = "w|"
+            if not target.endswith(".tar"):
+                mode = "w|gz"
+            self.archive = tarfile.open(target, mode)
+        else:
+            self.kind = "directory"
+            os.makedirs(target, exist_ok=True)
+
+    def write(self, name, data):
+        """ Writes the output of a single QR code
+
+        Raises a ValueError for names that could end up outside the target,
+        which are names with a path separator or "..".
+        """
+        name = str(name)
+        if not name or ".." in name or any(
+                separator in name for separator in "/\\"):
+            raise ValueError(
+                "Invalid name, use a name without path separators or ..")
+        filename = "{}.{}".format(name, self.extension)
+        if self.kind == "stdout":
+            sys.stdout.buffer.write(data + b"\n")
+        elif self.kind == "zip":
+            self.archive.writestr(filename, data)
+        elif self.kind == "tar":
+            info = tarfile.TarInfo(filename)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.archive.addfile(info, io.BytesIO(data))
+        else:
+            with open(os.path.join(self.target, filename), "wb") as f:
+                f.write(data)
+
+    def close(self):
+        """ Closes the archive (if any) or flushes stdout """
+        if self.archive is not None:
+            self.archive.close()
+        if self.kind == "stdout":
+            sys.stdout.flush()
+
+
+def main(args=None):
+    """ Generates QR codes for every line of the input
+
+    Parses the command line arguments and streams the input through
+    bulk.render_many into the output, one line at the time.
+    A summary of the throughput and failures is printed to stderr.
+    Returns the exit code: 0 if all QR codes were made, 1 otherwise.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m NoLQR",
+        description="Generate a QR code for every line of the input")
+    parser.add_argument(
+        "input", nargs="?", default="-",
+        help="file with one input per line, - for stdin (default)")
+    parser.add_argument(
+        "-o", "--output", default=".",
+        help="directory, .zip/.tar/.tar.gz archive or - for stdout")
+    parser.add_argument("-f", "--format", default="svg", choices=FORMATS)
+    parser.add_argument(
+        "-e", "--error-level", default="M", choices=list("LMQH"))
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="number of worker processes (default 1)")
+    parser.add_argument(
+        "--chunksize", type=int, default=64,
+        help="number of inputs per job (default 64)")
+    parser.add_argument(
+        "--ndjson", action="store_true",
+        help="read a json object per line with data and options")
+    parser.add_argument(
+        "--merged", action="store_true",
+        help="draw the svg as a single path of merged dark modules")
+    args = parser.parse_args(args)
+    defaults = {"error_level": args.error_level}
+    if args.merged:
+        if args.format != "svg":
+            parser.error("--merged can only be used with the svg format")
+        defaults["merged"] = True
+    if args.input == "-":
+        lines = sys.stdin.buffer
+    else:
+        lines = open(args.input, "rb")
+    writer = OutputWriter(args.output, args.format)
+    start = time.time()
+    done = 0
+    failures = 0
+
+    def failed(name, error):
+        nonlocal failures
+        failures += 1
+        print("{}: {}".format(name, error), file=sys.stderr)
+
+    try:
+        items = read_items(lines, args.ndjson, failed)
+        items = (dict(defaults, **item) for item in items)
+        for name, result in render_many(
+                items, args.format, args.jobs, args.chunksize,
+                return_exceptions=True):
+            if isinstance(result, Exception):
+                failed(name, result)
+                continue
+            try:
+                writer.write(name, result)
+            except ValueError as e:
+                failed(name, e)
+                continue
+            done += 1
+    finally:
+        writer.close()
+        lines.close()
+    duration = time.time() - start
+    print("Generated {} QR codes in {:.2f}s ({:.1f}/s), {} failed".format(
+        done, duration, done / duration if duration else 0, failures),
+        file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+# Asyncio support of NoLQR, QR code generation lighter than an unladen swallow
+# Made by Jelmerro, see README.md for more details
+# MIT, see LICENSE for details
+# https://github.com/Jelmerro/NoLQR for updates
+
+import asyncio
+import weakref
+
+from . import QRCode
+
+
+def generate(str_in, error_level, options):
+    """ Generates a QR code completely, so it's ready to be rendered """
+    code = QRCode(str_in, error_level, **options)
+    code.rows
+    return code
+
+
+def render_svg(code, args, kwargs):
+    """ Calls out_svg of the QR code with the provided arguments """
+    return code.out_svg(*args, **kwargs)
+
+
+def render_png(code, args, kwargs):
+    """ Calls out_png of the QR code with the provided arguments """
+    return code.out_png(*args, **kwargs)
+
+
+class AsyncRunner():
+    """ Runs the work of NoLQR in an executor from an event loop
+
+    At most "limit" jobs are running in the executor at the same time,
+    other jobs wait for a free spot without blocking the event loop.
+    Jobs with the same key that are still in progress are coalesced:
+    the job only runs once, and all callers get the same result.
+    When a caller is cancelled, the job keeps running for the others,
+    unless there are no callers left, in which case it's cancelled too.
+    The executor is the default executor of the event loop if None.
+    """
+
+    def __init__(self, limit=4, executor=None):
+        self.limit = limit
+        self.executor = executor
+        self.loops = weakref.WeakKeyDictionary()
+
+    def loop_state(self):
+        """ Returns the semaphore and in-flight jobs of the running loop
+
+        Asyncio objects are bound to the loop they are first used in,
+        so every event loop (like one per asyncio.run or per thread)
+        gets its own, which are dropped once the loop is gone.
+        """
+        loop = asyncio.get_running_loop()
+        state = self.loops.get(loop)
+        if state is None:
+            state = {"semaphore": asyncio.Semaphore(self.limit),
+                     "in_flight": {}}
+            self.loops[loop] = state
+        return state
+
+    async def run(self, key, function, *args):
+        """ Runs the function in the executor, coalesced by the key
+
+        Keys that can't be hashed are never coalesced.
+        """
+        try:
+            hash(key)
+        except TypeError:
+            key = object()
+        state = self.loop_state()
+        in_flight = state["in_flight"]
+        job = in_flight.get(key)
+        if job is None:
+            job = {"task": asyncio.ensure_future(self.run_limited(
+                state["semaphore"], function, *args)), "callers": 0}
+            in_flight[key] = job
+            job["task"].add_done_callback(
+                lambda _: in_flight.pop(key, None))
+        job["callers"] += 1
+        try:
+            return await asyncio.shield(job["task"])
+        except asyncio.CancelledError:
+            if job["callers"] == 1 and not job["task"].done():
+                job["task"].cancel()
+            raise
+        finally:
+            job["callers"] -= 1
+
+    async def run_limited(self, semaphore, function, *args):
+        """ Runs the function in the executor once there is a free spot """
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, function, *args)
+
+
+runner = AsyncRunner()
+
+
+def configure(limit=4, executor=None):
+    """ Configures the concurrency limit and executor for the functions
+
+    Should be called before the first call to any of the async functions.
+    """
+    global runner
+    runner = AsyncRunner(limit, executor)
+
+
+async def agenerate(str_in, error_level="M", **options):
+    """ Generates a QR code without blocking the event loop
+
+    Takes the same arguments as QRCode,
+    and returns the QR code once it's completely generated.
+    Identical calls that are still in progress share the same QR code.
+    """
+    key = ("generate", str_in, error_level, tuple(sorted(options.items())))
+    return await runner.run(key, generate, str_in, error_level, options)
+
+
+async def arender_svg(code, *args, **kwargs):
+    """ Renders a QR code as svg without blocking the event loop
+
+    The code can be a QRCode or a string (which is generated first),
+    the other arguments are passed to QRCode.out_svg.
+    Identical calls that are still in progress are only rendered once.
+    """
+    if not isinstance(code, QRCode):
+        code = await agenerate(code)
+    key = ("svg", id(code), args, tuple(sorted(kwargs.items())))
+    return await runner.run(key, render_svg, code, args, kwargs)
+
+
+async def arender_png(code, *args, **kwargs):
+    """ Renders a QR code as png without blocking the event loop
+
+    Same as arender_svg, but the arguments are passed to QRCode.out_png.
+    """
+    if not isinstance(code, QRCode):
+        code = await agenerate(code)
+    key = ("png", id(code), args, tuple(sorted(kwargs.items())))
+    return await runner.run(key, render_png, code, args, kwargs)
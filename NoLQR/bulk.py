@@ -0,0 +1,177 @@
+# Bulk generation of NoLQR, QR code generation lighter than an unladen swallow
+# Made by Jelmerro, see README.md for more details
+# MIT, see LICENSE for details
+# https://github.com/Jelmerro/NoLQR for updates
+
+import collections
+import concurrent.futures
+import io
+import mmap
+import os
+
+from . import QRCode
+
+
+def generate_chunk(items, error_level, options, return_exceptions):
+    """ Generates the QR codes for a chunk of items
+
+    This runs inside the worker processes of generate_many.
+    The QR codes are fully generated before they are returned,
+    and only the packed rows and plan are pickled (see QRCode.__getstate__).
+    The caches in util are kept by each worker process,
+    so any next chunk with the same versions can reuse them.
+    """
+    results = []
+    for item in items:
+        try:
+            code = QRCode(item, error_level, **options)
+            code.rows
+            results.append(code)
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
+def portable(item):
+    """ Returns the input in a form that can be sent to a worker process
+
+    Memoryviews and mmap objects can't be pickled, so they are copied,
+    paths are sent as is, and are memory-mapped by the worker instead.
+    """
+    if isinstance(item, (memoryview, mmap.mmap)):
+        return bytes(item)
+    return item
+
+
+def chunks(iterable, chunksize):
+    """ Splits the iterable into lists of chunksize items, lazily """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def generate_many(iterable, error_level="M", workers=None, chunksize=16,
+                  ordered=True, return_exceptions=False, executor=None,
+                  **options):
+    """ Generates many QR codes using a process pool
+
+    The input strings are read from the iterable in chunks,
+    and only a limited number of chunks is submitted at the same time,
+    so the iterable can be much larger than the memory (or infinite).
+    The generated QR codes are yielded as soon as they are ready,
+    in the same order as the input if ordered is True,
+    otherwise in the order they are finished (see QRCode.str_in).
+    Failing items raise the error, unless return_exceptions is True,
+    in which case the exception is yielded instead of a QRCode.
+    By default a new process pool is started with the number of workers,
+    but an existing executor can be provided to keep the workers around.
+    With a single worker and no executor, no process pool is used at all.
+    Any other keyword arguments (like mask_policy) are passed to QRCode.
+    The inputs can be anything QRCode accepts, such as bytes or paths.
+    """
+    if workers != 1 or executor is not None:
+        iterable = map(portable, iterable)
+    return map_chunks(
+        generate_chunk, iterable, workers, chunksize, ordered, executor,
+        error_level, options, return_exceptions)
+
+
+def render_chunk(items, output, return_exceptions):
+    """ Renders the QR codes for a chunk of items
+
+    Each item is a dict with at least the "data" to encode,
+    and optionally a "name", "error_level", "mask" and "mask_policy".
+    All other keys are passed to the out_ method of the output.
+    The output is written to a BytesIO stream and returned as bytes,
+    along with the name of the item: [name, output].
+    When return_exceptions is True, errors are returned as the output.
+    """
+    results = []
+    for item in items:
+        item = dict(item)
+        name = item.pop("name", None)
+        try:
+            options = {}
+            for key in ["mask", "mask_policy"]:
+                if key in item:
+                    options[key] = item.pop(key)
+            code = QRCode(
+                item.pop("data"), item.pop("error_level", "M"), **options)
+            stream = io.BytesIO()
+            getattr(code, "out_{}".format(output))(stream, **item)
+            results.append([name, stream.getvalue()])
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append([name, e])
+    return results
+
+
+def render_many(items, output="svg", workers=None, chunksize=16,
+                ordered=True, return_exceptions=False, executor=None):
+    """ Renders many QR codes using a process pool
+
+    Works the same as generate_many, but the items are dicts
+    (see render_chunk) and the rendered output is returned as bytes,
+    along with the name of the item: [name, output].
+    """
+    if workers != 1 or executor is not None:
+        items = (
+            dict(item, data=portable(item["data"])) if "data" in item
+            else item for item in items)
+    return map_chunks(
+        render_chunk, items, workers, chunksize, ordered, executor,
+        output, return_exceptions)
+
+
+def map_chunks(function, iterable, workers, chunksize, ordered, executor,
+               *args):
+    """ Calls the function for chunks of the iterable using a process pool
+
+    The function is called with the chunk and the other arguments,
+    and should return a list of results, which are yielded one by one.
+    Only a limited number of chunks is submitted at the same time.
+    """
+    if workers == 1 and executor is None:
+        for chunk in chunks(iterable, chunksize):
+            yield from function(chunk, *args)
+        return
+    limit = 2 * (workers or os.cpu_count() or 1)
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+    pending = collections.deque()
+    try:
+        for chunk in chunks(iterable, chunksize):
+            pending.append(executor.submit(function, chunk, *args))
+            while len(pending) >= limit:
+                yield from next_results(pending, ordered)
+        while pending:
+            yield from next_results(pending, ordered)
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown()
+
+
+def next_results(pending, ordered):
+    """ Waits for the next chunk and returns the results of it
+
+    When ordered, this is always the oldest chunk,
+    otherwise it's the first one to finish.
+    """
+    if ordered:
+        return pending.popleft().result()
+    done, _ = concurrent.futures.wait(
+        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+    future = done.pop()
+    pending.remove(future)
+    return future.result()
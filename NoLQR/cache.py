@@ -0,0 +1,131 @@
+# Result cache of NoLQR, QR code generation lighter than an unladen swallow
+# Made by Jelmerro, see README.md for more details
+# MIT, see LICENSE for details
+# https://github.com/Jelmerro/NoLQR for updates
+
+import collections
+import threading
+
+from . import QRCode, constants, util
+
+
+class ResultCache():
+    """ Thread-safe LRU cache for generated QR codes and their outputs
+
+    QR codes are stored in a compact form (see QRCode.__getstate__),
+    keyed by the input, error level, binary encoding and other options.
+    Rendered outputs (see render) are stored in the same cache.
+    The least recently used entries are evicted when there are more than
+    max_entries, or when the total size is more than max_bytes (if set).
+    The size of an entry is the length of the packed rows and the input,
+    or the length of the output for rendered entries.
+    The number of hits, misses and evictions are counted, see stats.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """ Returns the value for the key (or None) and counts the result """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def store(self, key, value, size):
+        """ Stores the value and evicts entries until the limits are met """
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.entries and self.over_limits():
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def over_limits(self):
+        """ Checks if there are too many entries or bytes in the cache """
+        if len(self.entries) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.size > self.max_bytes
+
+    def generate(self, str_in, error_level="M", **options):
+        """ Returns the QR code for the input, from the cache if possible
+
+        Takes the same arguments as QRCode,
+        and returns a new fully generated QRCode for every call.
+        The mask_executor only changes how fast the mask is picked,
+        so it's only used on a cache miss and isn't part of the key.
+        """
+        str_in = util.read_input(str_in)
+        mask_executor = options.pop("mask_executor", None)
+        key = (
+            "code", util.input_key(str_in), error_level.upper(),
+            constants.ENCODING,
+            tuple(sorted(options.items())))
+        state = self.lookup(key)
+        if state is None:
+            code = QRCode(
+                str_in, error_level, mask_executor=mask_executor, **options)
+            code.rows
+            state = code.__getstate__()
+            self.store(key, state, len(state["rows"]) + len(str_in))
+        else:
+            code = QRCode.__new__(QRCode)
+            code.__setstate__(state)
+        return code
+
+    def render(self, code, output, *args, **kwargs):
+        """ Returns the output of a QR code, from the cache if possible
+
+        The output is the name of the out_ method (like "svg"),
+        which is called with the other arguments on a cache miss.
+        Only outputs that are returned as str or bytes are stored.
+        The key uses the mask if it's forced or already picked,
+        otherwise the mask policy decides it, so the QR code is only
+        generated on a cache miss.
+        """
+        key = (
+            "render", util.input_key(code.str_in), code.err_lvl,
+            constants.ENCODING,
+            code.mask_policy, code._mask, output, args,
+            tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return getattr(code, "out_{}".format(output))(*args, **kwargs)
+        result = self.lookup(key)
+        if result is None:
+            result = getattr(code, "out_{}".format(output))(*args, **kwargs)
+            if isinstance(result, (str, bytes)):
+                self.store(key, result, len(result))
+        return result
+
+    def stats(self):
+        """ Returns the counters and size of the cache as a dict """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def clear(self):
+        """ Removes all entries from the cache, the counters are kept """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
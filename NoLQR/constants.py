@@ -33,6 +33,11 @@ MODES = {
 # and some other tutorials even recommend it over iso-8859-1.
 ENCODING = "utf-8"  # utf-8 or iso-8859-1
 
+# The masks of a QR code can be scored in parallel (see QRCode mask_executor).
+# For small versions, the overhead of the executor is bigger than the gain,
+# so only versions of at least this number are scored in parallel.
+PARALLEL_MASK_VERSION = 26
+
 # Alphanumeric code conversion table
 # A mapping for all the possible characters in alphanumeric encoding
 # This table is also used to check if the data only uses these characters.
@@ -697,3 +702,14 @@ FORMAT_STRING = {
           "001100111010000", "000011101100010", "000001001010101",
           "000110100001100", "000100000111011"]
 }
+
+# The named colors that can be used for raster outputs such as png,
+# other colors can be used as a hex color like "#1a2b3c" or "#abc".
+COLORS = {
+    "black": (0, 0, 0), "silver": (192, 192, 192), "gray": (128, 128, 128),
+    "white": (255, 255, 255), "maroon": (128, 0, 0), "red": (255, 0, 0),
+    "purple": (128, 0, 128), "fuchsia": (255, 0, 255), "green": (0, 128, 0),
+    "lime": (0, 255, 0), "olive": (128, 128, 0), "yellow": (255, 255, 0),
+    "navy": (0, 0, 128), "blue": (0, 0, 255), "teal": (0, 128, 128),
+    "aqua": (0, 255, 255)
+}
@@ -0,0 +1,149 @@
+# Disk cache of NoLQR, QR code generation lighter than an unladen swallow
+# Made by Jelmerro, see README.md for more details
+# MIT, see LICENSE for details
+# https://github.com/Jelmerro/NoLQR for updates
+
+import hashlib
+import mmap
+import os
+import tempfile
+
+from . import QRCode, constants, util
+
+
+class EmptyOutput(bytes):
+    """ Empty bytes that can be closed and used in a with statement
+
+    Empty files can't be memory-mapped, so this is returned instead,
+    which can be used in the same way as the memory-mapped files.
+    """
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DiskCache():
+    """ Content-addressed cache of rendered QR codes on disk
+
+    Each output is stored in a file named after a hash of the input,
+    the QRCode options and the output options (see key).
+    Files are written to a temporary file first and then renamed,
+    so other processes using the same directory never see partial files.
+    Reading a file updates the modification time,
+    which is used to remove the least recently used files,
+    once the total size of the files is more than max_bytes (if set).
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.files())
+
+    def key(self, str_in, error_level, options, output, render_options):
+        """ Returns the hash of everything that affects the output """
+        parts = repr((
+            util.input_key(util.read_input(str_in)), error_level.upper(),
+            constants.ENCODING,
+            sorted(options.items()), output, sorted(render_options.items())))
+        return hashlib.sha256(parts.encode("utf-8")).hexdigest()
+
+    def path(self, str_in, output="svg", error_level="M", options=None,
+             **render_options):
+        """ Returns the path of the rendered output, rendering it if needed
+
+        The options are passed to QRCode, the render options to the
+        out_ method of the output, which writes to a temporary file.
+        """
+        options = options or {}
+        key = self.key(str_in, error_level, options, output, render_options)
+        folder = os.path.join(self.directory, key[:2])
+        path = os.path.join(folder, "{}.{}".format(key, output))
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+        code = QRCode(str_in, error_level, **options)
+        os.makedirs(folder, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(
+            dir=folder, prefix=".tmp-", suffix=".{}".format(output))
+        try:
+            with os.fdopen(descriptor, "wb") as stream:
+                getattr(code, "out_{}".format(output))(
+                    stream, **render_options)
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        self.size += os.path.getsize(path)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.prune(keep=path)
+        return path
+
+    def read(self, str_in, output="svg", error_level="M", options=None,
+             **render_options):
+        """ Returns the rendered output as a memory-mapped file
+
+        Takes the same arguments as path.
+        The result can be used as bytes, and should be closed after use.
+        If another process prunes the file before it's opened,
+        it's rendered again (up to three times in total).
+        Empty files can't be memory-mapped, so EmptyOutput is returned.
+        """
+        for attempt in range(0, 3):
+            path = self.path(
+                str_in, output, error_level, options, **render_options)
+            try:
+                with open(path, "rb") as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        return EmptyOutput()
+                    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+    def files(self):
+        """ Returns the path, size and modification time of all the files """
+        files = []
+        for folder in os.scandir(self.directory):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.startswith(".tmp-"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+        return files
+
+    def prune(self, keep=None):
+        """ Removes the least recently used files until under max_bytes
+
+        The directory is scanned again first,
+        as other processes might have added or removed files.
+        The file at the keep path is never removed,
+        so a file that was just rendered is still there to be used,
+        even if it's bigger than max_bytes by itself.
+        """
+        files = sorted(self.files(), key=lambda file: file[2])
+        self.size = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if self.size <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
@@ -0,0 +1,275 @@
+# HTTP server of NoLQR, QR code generation lighter than an unladen swallow
+# Made by Jelmerro, see README.md for more details
+# MIT, see LICENSE for details
+# https://github.com/Jelmerro/NoLQR for updates
+
+import argparse
+import bisect
+import hashlib
+import http.server
+import threading
+import time
+import urllib.parse
+
+from . import QRCode, constants, plan
+from .cache import ResultCache
+
+# The content type of each output format the server can render
+FORMATS = {
+    "svg": "image/svg+xml",
+    "png": "image/png"
+}
+
+# The options passed to the out_ method of each output format
+OPTIONS = {
+    "svg": {"merged": True},
+    "png": {}
+}
+
+# The upper bounds in seconds of the latency histogram buckets
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# The pipeline stages that are timed, in the order they run
+STAGES = (
+    "plan", "codewords", "error_correction", "placement", "mask", "render")
+
+
+class Histogram():
+    """ Thread-safe latency histogram with fixed buckets
+
+    Counts the observations per bucket (see BUCKETS),
+    along with the total count and sum of all observations.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        """ Adds a single observation to the histogram """
+        with self.lock:
+            self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+            self.sum += seconds
+
+    def lines(self, name, labels):
+        """ Returns the histogram in the Prometheus text format
+
+        The counts are cumulative per bucket, as the format expects.
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(BUCKETS) + ["+Inf"], counts):
+            cumulative += count
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                name, labels, bound, cumulative))
+        lines.append("{}_sum{{{}}} {}".format(name, labels, total))
+        lines.append("{}_count{{{}}} {}".format(name, labels, cumulative))
+        return lines
+
+
+class Metrics():
+    """ Latency histograms per pipeline stage and response counters """
+
+    def __init__(self):
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.requests = Histogram()
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    def count(self, status):
+        """ Counts a response with the status code """
+        with self.lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+
+    def render(self, cache):
+        """ Returns all metrics in the Prometheus text format """
+        lines = ["# TYPE nolqr_stage_seconds histogram"]
+        for stage, histogram in self.stages.items():
+            lines += histogram.lines(
+                "nolqr_stage_seconds", 'stage="{}"'.format(stage))
+        lines.append("# TYPE nolqr_request_seconds histogram")
+        lines += self.requests.lines("nolqr_request_seconds", 'path="/qr"')
+        lines.append("# TYPE nolqr_responses_total counter")
+        with self.lock:
+            responses = sorted(self.responses.items())
+        for status, count in responses:
+            lines.append('nolqr_responses_total{{status="{}"}} {}'.format(
+                status, count))
+        for name, value in cache.stats().items():
+            lines.append("# TYPE nolqr_cache_{} gauge".format(name))
+            lines.append("nolqr_cache_{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+
+def render(str_in, error_level, output, metrics):
+    """ Generates the QR code and renders it, timing each stage
+
+    The lazy stages of QRCode are triggered one by one,
+    so the duration of each can be added to the metrics.
+    Returns the output as bytes.
+    """
+    code = QRCode(str_in, error_level)
+    steps = (
+        lambda: code.plan,
+        lambda: code.codewords,
+        lambda: code.data,
+        code.generate_data_matrix,
+        lambda: code.rows,
+        lambda: getattr(code, "out_{}".format(output))(**OPTIONS[output]))
+    for stage, step in zip(STAGES, steps):
+        start = time.perf_counter()
+        result = step()
+        metrics.stages[stage].observe(time.perf_counter() - start)
+    if isinstance(result, str):
+        result = result.encode("utf-8")
+    return result
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """ Request handler for the /qr and /metrics endpoints
+
+    The cache, metrics and max_age are set on the server (see serve).
+    """
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/qr":
+            start = time.perf_counter()
+            self.handle_qr(urllib.parse.parse_qs(
+                url.query, keep_blank_values=True))
+            self.server.metrics.requests.observe(
+                time.perf_counter() - start)
+        elif url.path == "/metrics":
+            body = self.server.metrics.render(self.server.cache)
+            self.respond(200, body.encode("utf-8"), {
+                "Content-Type": "text/plain; version=0.0.4",
+                "Cache-Control": "no-store"
+            })
+        else:
+            self.respond(404, b"Not found\n")
+
+    def handle_qr(self, query):
+        """ Renders the QR code for the query, from the cache if possible
+
+        The ETag is based on the query options only,
+        so a matching If-None-Match is answered without any rendering,
+        once the plan shows that the options would make a valid QR code.
+        Empty data is a valid QR code, other empty options use the default.
+        """
+        str_in = query.get("data", [None])[0]
+        error_level = query.get("level", [""])[0].upper() or "M"
+        output = query.get("format", [""])[0].lower() or "svg"
+        if str_in is None:
+            self.respond(400, b"Missing data parameter\n")
+            return
+        if output not in FORMATS:
+            self.respond(400, "Unsupported format, use one of: {}\n".format(
+                ", ".join(FORMATS)).encode("utf-8"))
+            return
+        key = ("serve", str_in, error_level, constants.ENCODING, output)
+        etag = '"{}"'.format(hashlib.sha256(
+            repr(key).encode("utf-8")).hexdigest()[:32])
+        headers = {
+            "ETag": etag,
+            "Cache-Control": "public, max-age={}".format(
+                self.server.max_age)
+        }
+        matches = self.headers.get("If-None-Match", "").split(",")
+        if {etag, "*"} & {match.strip() for match in matches}:
+            try:
+                plan(str_in, error_level)
+            except (ValueError, RuntimeError) as e:
+                self.respond(400, "{}\n".format(e).encode("utf-8"))
+                return
+            self.respond(304, b"", headers)
+            return
+        body = self.server.cache.lookup(key)
+        if body is None:
+            try:
+                body = render(
+                    str_in, error_level, output, self.server.metrics)
+            except (ValueError, RuntimeError) as e:
+                self.respond(400, "{}\n".format(e).encode("utf-8"))
+                return
+            self.server.cache.store(key, body, len(body))
+        headers["Content-Type"] = FORMATS[output]
+        self.respond(200, body, headers)
+
+    def respond(self, status, body, headers=None):
+        """ Sends the status, headers and body, and counts the response """
+        self.server.metrics.count(status)
+        self.send_response(status)
+        headers = headers or {"Content-Type": "text/plain; charset=utf-8"}
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304 and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def serve(host="127.0.0.1", port=8000, cache=None, max_age=86400,
+          quiet=False):
+    """ Returns a ThreadingHTTPServer that renders QR codes
+
+    All threads share the same ResultCache and metrics.
+    Call serve_forever on it to start handling requests.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.cache = cache or ResultCache()
+    server.metrics = Metrics()
+    server.max_age = max_age
+    server.quiet = quiet
+    return server
+
+
+def main(args=None):
+    """ Starts the server with the options from the command line """
+    parser = argparse.ArgumentParser(
+        prog="python -m NoLQR.serve",
+        description="Serve QR codes over HTTP at /qr?data=...")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--cache-entries", type=int, default=1024,
+        help="maximum number of cached QR codes (default 1024)")
+    parser.add_argument(
+        "--cache-bytes", type=int, default=None,
+        help="maximum size of the cache in bytes (default unlimited)")
+    parser.add_argument(
+        "--max-age", type=int, default=86400,
+        help="max-age of the Cache-Control header (default 86400)")
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="disable request logs")
+    args = parser.parse_args(args)
+    server = serve(
+        args.host, args.port,
+        ResultCache(args.cache_entries, args.cache_bytes),
+        args.max_age, args.quiet)
+    print("Serving QR codes on http://{}:{}/qr?data=...".format(
+        *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
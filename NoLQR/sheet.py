@@ -0,0 +1,291 @@
+# Label sheets of NoLQR, QR code generation lighter than an unladen swallow
+# Made by Jelmerro, see README.md for more details
+# MIT, see LICENSE for details
+# https://github.com/Jelmerro/NoLQR for updates
+
+import math
+import xml.sax.saxutils
+import zlib
+
+from . import QRCode, constants, util
+
+# Points per millimeter, the unit of a pdf page
+POINTS_PER_MM = 72 / 25.4
+
+# Width of a character in the (monospaced) caption font relative to its size
+CHARACTER_WIDTH = 0.6
+
+
+def decimal(value):
+    """ Formats a number with at most 4 decimals and no trailing zeros """
+    return "{:.4f}".format(value).rstrip("0").rstrip(".")
+
+
+def finder_free_rows(code):
+    """ Returns the rows of a QR code without the three finder patterns
+
+    The finder patterns are drawn from a single shared definition,
+    so the 7x7 modules of each of them are cleared from the packed rows.
+    """
+    right = (1 << 7) - 1
+    left = right << (code.width - 7)
+    rows = list(code.rows)
+    for y in range(7):
+        rows[y] &= ~(left | right)
+        rows[code.width - 1 - y] &= ~left
+    return rows
+
+
+def layout(page_width, page_height, margin, columns, rows, caption_height):
+    """ Returns the position and size of the cells of a page
+
+    Each cell is a tuple of the x and y of the top left corner of the
+    QR code (including the quiet zone) and the size of it.
+    The QR codes are as big as the cells allow, with room for a caption,
+    and are centered horizontally within their cell.
+    """
+    cell_width = (page_width - 2 * margin) / columns
+    cell_height = (page_height - 2 * margin) / rows
+    size = min(cell_width, cell_height - caption_height)
+    if size <= 0:
+        raise ValueError(
+            "Cells are too small for the QR codes, use fewer rows or columns")
+    return [
+        (margin + column * cell_width + (cell_width - size) / 2,
+         margin + row * cell_height, size)
+        for row in range(rows) for column in range(columns)]
+
+
+def placements(codes, captions, cells):
+    """ Yields the QR codes of each page, along with the cell and caption
+
+    Each page is a list of (code, caption, cell) tuples,
+    without any codes there is a single empty page.
+    The captions argument is either None for no captions,
+    True to use the input of the QR code, or a function that gets the code.
+    Binary captions are decoded, replacing any invalid characters.
+    """
+    page = []
+    for code in codes:
+        caption = None
+        if captions is True:
+            caption = code.str_in
+        elif captions:
+            caption = captions(code)
+        if caption is not None and not isinstance(caption, str):
+            caption = util.input_key(caption).decode(
+                constants.ENCODING, "replace")
+        page.append((code, caption, cells[len(page)]))
+        if len(page) == len(cells):
+            yield page
+            page = []
+    if page or not codes:
+        yield page
+
+
+def svg_chunks(codes, captions, cells, page_width, page_height,
+               font_size, dark, light):
+    """ Yields the svg of the sheet, with one chunk per page
+
+    The pages are placed below each other in a single svg.
+    The finder patterns are defined once and reused in every QR code.
+    """
+    pages = max(1, math.ceil(len(codes) / len(cells)))
+    yield '<?xml version="1.0" encoding="UTF-8" ?>\n' \
+        '<!-- Generated with NoLQR, QR code generation lighter ' \
+        'than an unladen swallow -->\n' \
+        '<!-- Visit https://github.com/Jelmerro/NoLQR ' \
+        'for updates and details -->\n' \
+        '<svg width="{0}mm" height="{1}mm" viewBox="0 0 {0} {1}" ' \
+        'xmlns="http://www.w3.org/2000/svg" ' \
+        'xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1">\n' \
+        '<defs>\n' \
+        '    <path id="finder" d="M0 0h7v7h-7zM1 1v5h5v-5zM2 2h3v3h-3z" />\n' \
+        '</defs>\n'.format(
+            decimal(page_width), decimal(page_height * pages))
+    for index, page in enumerate(placements(codes, captions, cells)):
+        out = [
+            '<g transform="translate(0 {})" fill="{}">\n'.format(
+                decimal(index * page_height), dark),
+            '    <rect width="{}" height="{}" fill="{}" />\n'.format(
+                decimal(page_width), decimal(page_height), light)]
+        for code, caption, (x, y, size) in page:
+            module = size / (code.width + 4)
+            out.append(
+                '    <g transform="translate({} {}) scale({})">'.format(
+                    decimal(x + 2 * module), decimal(y + 2 * module),
+                    decimal(module)))
+            out.append(
+                '<use xlink:href="#finder" />'
+                '<use xlink:href="#finder" x="{0}" />'
+                '<use xlink:href="#finder" y="{0}" />'.format(code.width - 7))
+            path = []
+            for row_y, row in enumerate(finder_free_rows(code)):
+                for row_x, length in util.dark_runs(row, code.width):
+                    path.append("M{} {}h{}v1h-{}z".format(
+                        row_x, row_y, length, length))
+            out.append('<path d="{}" /></g>\n'.format("".join(path)))
+            if caption is not None:
+                out.append(
+                    '    <text x="{}" y="{}" font-size="{}" '
+                    'font-family="monospace" text-anchor="middle">'
+                    '{}</text>\n'.format(
+                        decimal(x + size / 2), decimal(y + size + font_size),
+                        decimal(font_size), xml.sax.saxutils.escape(caption)))
+        out.append("</g>\n")
+        yield "".join(out)
+    yield "</svg>\n"
+
+
+def pdf_object(number, body):
+    """ Returns a pdf object with the number and body """
+    return b"%d 0 obj\n%s\nendobj\n" % (number, body)
+
+
+def pdf_stream(dictionary, data):
+    """ Returns the body of a compressed pdf stream """
+    data = zlib.compress(data)
+    dictionary += b" /Length %d /Filter /FlateDecode" % len(data)
+    return b"<< %s >>\nstream\n%s\nendstream" % (dictionary.strip(), data)
+
+
+def pdf_text(text):
+    """ Returns the text as a pdf string in the WinAnsi encoding """
+    text = text.replace("\r", " ").replace("\n", " ")
+    text = text.encode("cp1252", errors="replace")
+    for character in [b"\\", b"(", b")"]:
+        text = text.replace(character, b"\\" + character)
+    return b"(" + text + b")"
+
+
+def pdf_color(color):
+    """ Returns the red, green and blue values of a color for pdf """
+    return " ".join(decimal(value / 255) for value in util.color_rgb(color))
+
+
+def pdf_chunks(codes, captions, cells, page_width, page_height,
+               font_size, dark, light):
+    """ Yields the pdf of the sheet, with one chunk per object
+
+    The pages are written one at the time, while keeping track of the
+    offset of each object for the cross-reference table at the end.
+    The finder patterns are a single form XObject used by all QR codes.
+    The content of each page is in millimeters from the top left corner.
+    The colors are the fill colors for pdf, see pdf_color.
+    """
+    offsets = {}
+    written = 0
+    width = decimal(page_width * POINTS_PER_MM).encode()
+    height = decimal(page_height * POINTS_PER_MM).encode()
+    scale = "{:.6f}".format(POINTS_PER_MM).encode()
+    shared = [
+        (1, b"<< /Type /Catalog /Pages 2 0 R >>"),
+        (3, pdf_stream(
+            b"/Type /XObject /Subtype /Form /BBox [0 0 7 7]",
+            b"0 0 7 7 re 1 1 5 5 re 2 2 3 3 re f*")),
+        (4, b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier "
+            b"/Encoding /WinAnsiEncoding >>")]
+    chunk = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+    yield chunk
+    written += len(chunk)
+    for object_number, body in shared:
+        offsets[object_number] = written
+        chunk = pdf_object(object_number, body)
+        yield chunk
+        written += len(chunk)
+    kids = []
+    for page in placements(codes, captions, cells):
+        page_number = 5 + 2 * len(kids)
+        kids.append(b"%d 0 R" % page_number)
+        content = [
+            b"q %s 0 0 -%s 0 %s cm" % (scale, scale, height),
+            "{} rg 0 0 {} {} re f".format(
+                light, decimal(page_width),
+                decimal(page_height)).encode(),
+            "{} rg".format(dark).encode()]
+        for code, caption, (x, y, size) in page:
+            module = size / (code.width + 4)
+            content.append("q {0} 0 0 {0} {1} {2} cm /Finder Do "
+                           "q 1 0 0 1 {3} 0 cm /Finder Do Q "
+                           "q 1 0 0 1 0 {3} cm /Finder Do Q".format(
+                               decimal(module), decimal(x + 2 * module),
+                               decimal(y + 2 * module),
+                               code.width - 7).encode())
+            for row_y, row in enumerate(finder_free_rows(code)):
+                for row_x, length in util.dark_runs(row, code.width):
+                    content.append(b"%d %d %d 1 re" % (row_x, row_y, length))
+            content.append(b"f Q")
+            if caption is not None:
+                text_x = x + size / 2 - (
+                    len(caption) * CHARACTER_WIDTH * font_size / 2)
+                content.append(b"BT /F1 %s Tf 1 0 0 -1 %s %s Tm %s Tj ET" % (
+                    decimal(font_size).encode(), decimal(text_x).encode(),
+                    decimal(y + size + font_size).encode(),
+                    pdf_text(caption)))
+        content.append(b"Q")
+        objects = [
+            (page_number, b"<< /Type /Page /Parent 2 0 R "
+                b"/MediaBox [0 0 %s %s] /Resources << "
+                b"/XObject << /Finder 3 0 R >> /Font << /F1 4 0 R >> >> "
+                b"/Contents %d 0 R >>" % (width, height, page_number + 1)),
+            (page_number + 1, pdf_stream(b"", b"\n".join(content)))]
+        for object_number, body in objects:
+            offsets[object_number] = written
+            chunk = pdf_object(object_number, body)
+            yield chunk
+            written += len(chunk)
+    offsets[2] = written
+    chunk = pdf_object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(kids), len(kids)))
+    yield chunk
+    written += len(chunk)
+    size = max(offsets) + 1
+    xref = [b"xref\n0 %d\n0000000000 65535 f \n" % size]
+    for object_number in range(1, size):
+        xref.append(b"%010d 00000 n \n" % offsets[object_number])
+    xref.append(b"trailer\n<< /Size %d /Root 1 0 R >>\n" % size)
+    xref.append(b"startxref\n%d\n%%%%EOF\n" % written)
+    yield b"".join(xref)
+
+
+def out_sheet(codes,
+              filename=None,
+              output="svg",
+              page_width=210,
+              page_height=297,
+              margin=10,
+              columns=4,
+              rows=6,
+              captions=None,
+              font_size=3,
+              dark="black",
+              light="white"):
+    """ Output a batch of QR codes as label sheets
+
+    Lays out the QR codes in a grid of columns by rows on each page,
+    and outputs all pages as a single svg or pdf document.
+    The codes can be QRCode objects or strings (generated with level M).
+    All sizes are in millimeters, the default page size is A4.
+    With captions, the text is shown below each QR code (see placements).
+    The pages are streamed to the filename or writable stream one by one,
+    without either the output is returned as str (svg) or bytes (pdf).
+    Colors for the pdf output are hex colors or the names in constants.
+    """
+    if output not in ("svg", "pdf"):
+        raise ValueError("Invalid sheet output, use svg (default) or pdf")
+    codes = [
+        code if isinstance(code, QRCode) else QRCode(code) for code in codes]
+    caption_height = font_size * 1.5 if captions else 0
+    cells = layout(
+        page_width, page_height, margin, columns, rows, caption_height)
+    if output == "svg":
+        chunks = svg_chunks(
+            codes, captions, cells, page_width, page_height,
+            font_size, dark, light)
+    else:
+        chunks = pdf_chunks(
+            codes, captions, cells, page_width, page_height,
+            font_size, pdf_color(dark), pdf_color(light))
+    if filename is None:
+        chunks = list(chunks)
+    return util.write_output(filename, chunks, output, output == "pdf")
@@ -0,0 +1,238 @@
+# QR templates of NoLQR, QR code generation lighter than an unladen swallow
+# Made by Jelmerro, see README.md for more details
+# MIT, see LICENSE for details
+# https://github.com/Jelmerro/NoLQR for updates
+
+import bisect
+
+from . import QRCode, constants, util
+
+# The modes that can be used for the field of a template
+FIELD_MODES = ["numeric", "alphanumeric", "binary"]
+
+
+def interleaved_positions(lengths, start):
+    """ Returns the positions of the codewords of each block after interleaving
+
+    The lengths are the number of codewords of each block,
+    the start is the position of the first codeword (see interleave_codewords).
+    """
+    positions = [[] for _ in lengths]
+    position = start
+    for i in range(0, max(lengths)):
+        for block, length in enumerate(lengths):
+            if i < length:
+                positions[block].append(position)
+                position += 1
+    return positions
+
+
+class QRTemplate():
+    """ Template for QR codes that only differ in a field at the end
+
+    The input of every QR code is the fixed prefix followed by the field,
+    which always has the same length and mode (like a serial number).
+    As the layout of the data bits is the same for every field,
+    the codewords, error correction and modules of the prefix and padding
+    are generated once, with a field of only zero bits.
+    Reed-Solomon error correction is linear, so the error correction of a
+    field is the xor of the template and the contribution of the field bytes.
+    Rendering a field only updates the codewords that contain the field,
+    the error correction blocks they are in, and the modules of both.
+    The version is the smallest that fits when None.
+    """
+
+    def __init__(self, prefix, field_length, version=None, error_level="M",
+                 field_mode="numeric", mask=None, mask_policy="full"):
+        if error_level.upper() not in list("LMQH"):
+            raise ValueError("Invalid error level, use L, M (default), Q or H")
+        if field_mode not in FIELD_MODES:
+            raise ValueError(
+                "Invalid field mode, use numeric (default), "
+                "alphanumeric or binary")
+        if not isinstance(field_length, int) or field_length < 1:
+            raise ValueError("Invalid field length, use a positive number")
+        if version is not None and version not in constants.VERSIONS:
+            raise ValueError("Invalid version, use 1 to 40 or None (default)")
+        self.prefix = prefix
+        self.field_length = field_length
+        self.field_mode = field_mode
+        self.err_lvl = error_level.upper()
+        self.mask = mask
+        self.mask_policy = mask_policy
+        self.segments, self.version, self.bits = self.plan_segments(version)
+        self.width = util.width(self.version)
+        self.capacity = constants.VERSIONS[self.version][self.err_lvl]
+        self.generate_template()
+
+    def plan_segments(self, version):
+        """ Picks the segments of the prefix and the version
+
+        The prefix is split in segments like any other input,
+        the field is always a separate segment after it.
+        Returns the segments (with the field as zeros),
+        the version and the total number of bits.
+        """
+        zero_field = "0"
+        if self.field_mode == "binary":
+            zero_field = "\x00"
+        field_segment = [self.field_mode, zero_field * self.field_length]
+        capacities = util.BIT_CAPACITIES[self.err_lvl]
+        for first_version, last_version in util.VERSION_RANGES:
+            if version is not None:
+                if not first_version <= version <= last_version:
+                    continue
+                first_version = last_version = version
+            segments, bits = [], 0
+            if self.prefix:
+                segments, bits = util.optimal_segments(
+                    self.prefix, first_version)
+            bits += util.total_bits(
+                first_version, self.field_mode, self.field_length)
+            index = bisect.bisect_left(
+                capacities, bits, first_version - 1, last_version)
+            if index < last_version:
+                return segments + [field_segment], index + 1, bits
+        if version is not None:
+            raise RuntimeError(
+                "Provided data too big for QR version {}".format(version))
+        raise util.data_too_big(self.err_lvl)
+
+    def generate_template(self):
+        """ Generates the codewords, data and modules with a zero field
+
+        Also prepares what's needed to update them for a field:
+        the codewords that contain the field bits,
+        the error correction contribution of each of their bits,
+        and the modules of every codeword that can change.
+        """
+        code = QRCode(
+            self.prefix + self.segments[-1][1], self.err_lvl, self.mask,
+            self.mask_policy)
+        code._plan = self.plan(code.str_in)
+        prefix_bits = len(util.encode_segments(
+            self.segments[:-1], self.version))
+        header_bits = 4 + util.character_count_indicator_length(
+            self.field_mode, self.version)
+        self.field_bits = util.total_bits(
+            self.version, self.field_mode, self.field_length) - header_bits
+        self.field_shift = self.capacity - (
+            prefix_bits + header_bits + self.field_bits)
+        self.codewords = code.codewords
+        self.data = code.data
+        code.generate_data_matrix()
+        self.data_rows = code._data_rows
+        info = constants.ERROR_CORRECTION_BLOCKS[self.version][self.err_lvl]
+        lengths = [info[2]] * info[1] + [info[4]] * info[3]
+        data_positions = interleaved_positions(lengths, 0)
+        self.error_positions = interleaved_positions(
+            [info[0]] * len(lengths), len(self.codewords))
+        self.error_length = info[0]
+        first = (prefix_bits + header_bits) // 8
+        last = (prefix_bits + header_bits + self.field_bits - 1) // 8
+        self.field_codewords = []
+        index = 0
+        for block, length in enumerate(lengths):
+            for offset in range(0, length):
+                if first <= index <= last:
+                    basis = []
+                    for bit in range(0, 8):
+                        block_bytes = bytearray(length)
+                        block_bytes[offset] = 1 << bit
+                        basis.append(int.from_bytes(
+                            util.new_error_block(block_bytes, info), "big"))
+                    table = [0]
+                    for value in range(1, 256):
+                        low = (value & -value).bit_length() - 1
+                        table.append(table[value & (value - 1)] ^ basis[low])
+                    self.field_codewords.append(
+                        (index, block, data_positions[block][offset], table))
+                index += 1
+        positions = code.generate_data_positions()
+        self.modules = {}
+        changing = [position for _, _, position, _ in self.field_codewords]
+        for _, block, _, _ in self.field_codewords:
+            changing += self.error_positions[block]
+        for position in changing:
+            bits = []
+            for bit in range(0, 8):
+                y, x = divmod(positions[8 * position + bit], self.width)
+                bits.append((y, 1 << (self.width - 1 - x)))
+            self.modules[position] = bits
+
+    def plan(self, str_in):
+        """ Returns the plan of a QR code made with the template, see plan """
+        segments = self.segments[:-1] + [
+            [self.field_mode, str_in[len(self.prefix):]]]
+        mode = "mixed"
+        if len(segments) == 1:
+            mode = self.field_mode
+        return {
+            "mode": mode,
+            "segments": segments,
+            "version": self.version,
+            "width": self.width,
+            "bits": self.bits,
+            "remaining": self.capacity - self.bits
+        }
+
+    def field_value(self, field):
+        """ Returns the data bits of the field as an int
+
+        Numeric fields can be an int, which is padded with zeros.
+        Raises a ValueError if the field doesn't match the template.
+        """
+        if isinstance(field, int) and self.field_mode == "numeric":
+            field = "{:0{}d}".format(field, self.field_length)
+        if self.field_mode == "numeric":
+            valid = field.isascii() and field.isdigit()
+        elif self.field_mode == "alphanumeric":
+            valid = all(c in constants.ALPHA_TABLE for c in field)
+        else:
+            valid = len(field.encode(constants.ENCODING)) == len(field)
+        if not valid or len(field) != self.field_length:
+            raise ValueError(
+                "Invalid field, use {} {} characters".format(
+                    self.field_length, self.field_mode))
+        bits = util.encode_segments([[self.field_mode, field]], self.version)
+        value = int.from_bytes(bits.to_bytes(), "big") >> (-len(bits) % 8)
+        return field, value & ((1 << self.field_bits) - 1)
+
+    def render(self, field):
+        """ Returns the QR code for the prefix and the field
+
+        Only the codewords and modules that depend on the field are updated,
+        the mask is picked as usual once the rows of the QR code are needed.
+        """
+        field, value = self.field_value(field)
+        value <<= self.field_shift
+        codewords = bytearray(self.codewords)
+        data = bytearray(self.data)
+        rows = list(self.data_rows)
+        error_blocks = {}
+        changes = []
+        for index, block, position, table in self.field_codewords:
+            byte = (value >> (self.capacity - 8 * (index + 1))) & 255
+            if byte:
+                codewords[index] ^= byte
+                changes.append((position, byte))
+                error_blocks[block] = error_blocks.get(block, 0) ^ table[byte]
+        for block, error in error_blocks.items():
+            error_bytes = error.to_bytes(self.error_length, "big")
+            for position, byte in zip(
+                    self.error_positions[block], error_bytes):
+                if byte:
+                    changes.append((position, byte))
+        for position, byte in changes:
+            data[position] ^= byte
+            for bit, (y, module) in enumerate(self.modules[position]):
+                if byte & (128 >> bit):
+                    rows[y] ^= module
+        code = QRCode(
+            self.prefix + field, self.err_lvl, self.mask, self.mask_policy)
+        code._plan = self.plan(code.str_in)
+        code._codewords = bytes(codewords)
+        code._data = bytes(data)
+        code.generate_static_matrix()
+        code._data_rows = tuple(rows)
+        return code
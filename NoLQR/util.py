@@ -3,37 +3,109 @@
 # MIT, see LICENSE for details
 # https://github.com/Jelmerro/NoLQR for updates
 
+import bisect
+import io
+import mmap
+import os
+import re
+import struct
+import zlib
+
 from . import constants
 
 
+class BitBuffer():
+    """ Bit writer backed by a bytearray
+
+    Values are appended with a given number of bits,
+    most significant bit first.
+    Complete bytes are moved into the bytearray right away,
+    and only the last few bits (less than 8) are kept in an int.
+    This makes it possible to share the data as bytes,
+    through the entire encode, padding and error correction steps.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pending = 0
+        self.pending_length = 0
+
+    def __len__(self):
+        return len(self.buffer) * 8 + self.pending_length
+
+    def append(self, value, length):
+        """ Appends the lowest "length" bits of the value """
+        self.pending = (self.pending << length) | value
+        self.pending_length += length
+        if self.pending_length >= 8:
+            rest = self.pending_length % 8
+            self.buffer += (self.pending >> rest).to_bytes(
+                self.pending_length // 8, "big")
+            self.pending &= (1 << rest) - 1
+            self.pending_length = rest
+
+    def extend(self, data):
+        """ Appends all the bytes of the data (bytes-like) """
+        if self.pending_length:
+            self.append(int.from_bytes(data, "big"), len(data) * 8)
+        else:
+            self.buffer += data
+
+    def to_bytes(self):
+        """ Returns the bits as bytes, zero padding the last byte """
+        if self.pending_length:
+            return bytes(self.buffer) + bytes(
+                [self.pending << (8 - self.pending_length)])
+        return bytes(self.buffer)
+
+
+def read_input(data):
+    """ Returns the input of a QR code as a str or a bytes-like object
+
+    Strings, bytes and bytearrays are used as is.
+    Other buffers (like memoryview or mmap) become a flat memoryview,
+    and paths (os.PathLike) are memory-mapped read-only,
+    so the bytes are never copied before they are encoded.
+    """
+    if isinstance(data, (str, bytes, bytearray)):
+        return data
+    if isinstance(data, os.PathLike):
+        with open(data, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return memoryview(data).cast("B")
+    except TypeError:
+        raise ValueError(
+            "Invalid input, use a str, a bytes-like object or a path") \
+            from None
+
+
+def input_key(data):
+    """ Returns the input (see read_input) as str or bytes
+
+    Used to hash or pickle the input, so only buffers are copied.
+    """
+    if isinstance(data, (str, bytes)):
+        return data
+    return bytes(data)
+
+
 def best_mode(data):
     """ Picks the best mode for the input data
 
     If the data only contains digits, use numeric.
     If the data can be encoded using alphanumeric, use it.
-    To decide between kanji and binary,
-    the data is encoded in utf-8 or iso-8859-1 first.
-    If there is a single character that doesn't fit,
-    the data will be encoded with shift-jis.
-    If that works, the encoding mode will be kanji,
-    but if it fails, binary will be used.
+    If every character is supported by kanji (see kanji_values), use it.
     Binary is the default, when none of the other modes would work.
-    During the encoding of kanji,
-    the mode might switch back to binary when needed.
     """
-    if data.isdigit():
+    if data.isascii() and data.isdigit():
         return "numeric"
     if all(c in set(constants.ALPHA_TABLE) for c in data):
         return "alphanumeric"
-    total_length = 0
-    for character in data.encode(constants.ENCODING):
-        total_length += len("{:08b}".format(character))
-    if total_length > len(data) * 8:
-        try:
-            data.encode("shift-jis")
-            return "kanji"
-        except UnicodeEncodeError:
-            pass
+    if data and kanji_values(data) is not None:
+        return "kanji"
     return "binary"
 
 
@@ -72,21 +144,313 @@ def version(mode, number_of_characters, error_level):
 
     The amount of data a version can hold,
     depends on the error correction level.
-    The length of the data of a version,
-    is compared to the storage capacity.
-    If it doesn't fit, the next version will be tried.
+    The number of characters is looked up in the capacity index,
+    which is sorted by version, so bisect finds the first that fits.
     When the data doesn't fit any version,
     a RuntimeError informs the user of this.
     """
-    for i in range(1, 41):
-        total = total_bits(i, mode, number_of_characters)
-        if total <= constants.VERSIONS[i][error_level]:
-            return i
+    capacities = CHARACTER_CAPACITIES[mode][error_level]
+    index = bisect.bisect_left(capacities, number_of_characters)
+    if index == len(capacities):
+        raise data_too_big(error_level)
+    return index + 1
+
+
+def character_capacity(version, mode, error_level):
+    """ Calculates the maximum number of characters for a version
+
+    This is the reverse of total_bits:
+    the bits left after the mode and character count indicator,
+    are divided by the bits needed per character (or group of them).
+    The result is capped by the largest possible character count.
+    """
+    available = constants.VERSIONS[version][error_level] - 4
+    cc_length = character_count_indicator_length(mode, version)
+    available -= cc_length
+    capacity = 0
+    if mode == "numeric":
+        capacity = 3 * (available // 10)
+        if available % 10 >= 7:
+            capacity += 2
+        elif available % 10 >= 4:
+            capacity += 1
+    if mode == "alphanumeric":
+        capacity = 2 * (available // 11)
+        if available % 11 >= 6:
+            capacity += 1
+    if mode == "binary":
+        capacity = available // 8
+    if mode == "kanji":
+        capacity = available // 13
+    return min(capacity, 2 ** cc_length - 1)
+
+
+def data_too_big(error_level):
+    """ Creates the error for data that doesn't fit any version
+
+    Suggests a lower error correction level when there is one.
+    """
     if error_level == "L":
-        raise RuntimeError("Provided data too big for any QR version")
-    raise RuntimeError("Provided data too big for any QR version, "
-                       "try a lower error correction level than "
-                       "{}".format(error_level))
+        return RuntimeError("Provided data too big for any QR version")
+    return RuntimeError("Provided data too big for any QR version, "
+                        "try a lower error correction level than "
+                        "{}".format(error_level))
+
+
+def kanji_values(text):
+    """ Converts the text to a list of 13 bit kanji values
+
+    The text is encoded with shift-jis once,
+    and only double byte characters in the kanji ranges are supported:
+    8140 to 9FFC and E040 to EBBF (hexadecimal).
+    When every character is double byte, the length is exactly twice
+    the number of characters, so the bytes can be read in pairs.
+    From each pair, 8140 or C140 is subtracted respectively.
+    The most significant byte is multiplied by C0,
+    and the least significant byte is added to form the value.
+    If any character isn't supported, None is returned right away,
+    so the text needs to be encoded with another mode instead.
+    """
+    try:
+        encoded = text.encode("shift-jis")
+    except UnicodeEncodeError:
+        return None
+    if len(encoded) != 2 * len(text):
+        return None
+    values = []
+    for high, low in zip(encoded[::2], encoded[1::2]):
+        if 0x81 <= high <= 0x9f:
+            high -= 0x81
+        elif 0xe0 <= high <= 0xeb:
+            high -= 0xc1
+        else:
+            return None
+        if high == 0x2a and low > 0xbf:
+            return None
+        values.append(high * 0xc0 + low - 0x40)
+    return values
+
+
+def kanji_value(character):
+    """ Converts a single character to the 13 bit kanji value
+
+    See kanji_values, returns None if the character isn't supported.
+    """
+    values = kanji_values(character)
+    if values is None:
+        return None
+    return values[0]
+
+
+def segment_step(mode, residue, character):
+    """ Calculates the bits needed to add a character to a segment
+
+    The residue is the number of characters in the segment,
+    modulo the size of a group for (alpha)numeric data.
+    Numeric groups take 4, 7 or 10 bits for 1, 2 or 3 digits,
+    and alphanumeric groups take 6 or 11 bits for 1 or 2 characters.
+    Returns the additional bits and the new residue.
+    """
+    if mode == "numeric":
+        return (3 if residue else 4), (residue + 1) % 3
+    if mode == "alphanumeric":
+        return (5 if residue else 6), (residue + 1) % 2
+    if mode == "binary":
+        return 8 * len(character.encode(constants.ENCODING)), 0
+    return 13, 0
+
+
+def optimal_segments(data, first_version):
+    """ Splits the data in the segments with the fewest bits
+
+    See optimal_range_segments, for the range of the first version.
+    Returns a list of [mode, text] segments and the total number of bits.
+    """
+    return optimal_range_segments(data, [first_version])[0]
+
+
+def character_moves(character):
+    """ Returns the modes that can encode the character and their steps
+
+    For each mode, the steps are a dict with the bits and new residue
+    for every residue of a segment in that mode (see segment_step).
+    """
+    modes = ["binary"]
+    if character in constants.ALPHA_TABLE:
+        modes.append("alphanumeric")
+        if character.isdigit():
+            modes.append("numeric")
+    elif kanji_value(character) is not None:
+        modes.append("kanji")
+    residues = {"numeric": 3, "alphanumeric": 2}
+    return [
+        (mode, {
+            residue: segment_step(mode, residue, character)
+            for residue in range(0, residues.get(mode, 1))})
+        for mode in modes]
+
+
+def optimal_range_segments(data, first_versions):
+    """ Splits the data in the segments with the fewest bits per version
+
+    Each character can be encoded by one or more modes,
+    and every switch to another mode costs a mode indicator,
+    plus a character count indicator (which depends on the version).
+    This is solved with dynamic programming over the characters,
+    keeping the cheapest way to end in each mode and group residue.
+    The characters are only read once for all versions,
+    which each have their own costs as the indicator lengths differ.
+    Returns a list of segments and total bits for each of the versions.
+    """
+    headers = [{
+        mode: 4 + character_count_indicator_length(mode, first_version)
+        for mode in constants.MODES} for first_version in first_versions]
+    if not data:
+        mode = best_mode(data)
+        return [([[mode, data]], header[mode]) for header in headers]
+    moves_cache = {}
+    costs = [{} for _ in headers]
+    pointers = [[] for _ in headers]
+    for character in data:
+        moves = moves_cache.get(character)
+        if moves is None:
+            moves = character_moves(character)
+            moves_cache[character] = moves
+        for header, range_costs, range_pointers in zip(
+                headers, costs, pointers):
+            best_state = None
+            if range_costs:
+                best_state = min(range_costs, key=range_costs.get)
+            best_cost = range_costs.get(best_state, 0)
+            new_costs = {}
+            new_pointers = {}
+            for mode, steps in moves:
+                for state, cost in range_costs.items():
+                    if state[0] != mode:
+                        continue
+                    step, residue = steps[state[1]]
+                    cost += step
+                    if cost < new_costs.get((mode, residue), cost + 1):
+                        new_costs[mode, residue] = cost
+                        new_pointers[mode, residue] = state, False
+                step, residue = steps[0]
+                cost = best_cost + header[mode] + step
+                if cost < new_costs.get((mode, residue), cost + 1):
+                    new_costs[mode, residue] = cost
+                    new_pointers[mode, residue] = best_state, True
+            range_costs.clear()
+            range_costs.update(new_costs)
+            range_pointers.append(new_pointers)
+    results = []
+    for range_costs, range_pointers in zip(costs, pointers):
+        state = min(range_costs, key=range_costs.get)
+        total = range_costs[state]
+        segments = []
+        end = len(data)
+        for index in range(len(data) - 1, -1, -1):
+            previous, new_segment = range_pointers[index][state]
+            if new_segment:
+                segments.insert(0, [state[0], data[index:end]])
+                end = index
+            state = previous
+        results.append((segments, total))
+    return results
+
+
+def minimum_bits(data):
+    """ Returns a lower bound for the number of bits to encode the data
+
+    Each digit needs at least 10/3 bits, other alphanumeric characters 5.5,
+    and any other character 8 (or 13 for kanji).
+    Every segment starts with a mode indicator of 4 bits.
+    Only counts characters, so it's much quicker than optimal_segments.
+    """
+    digits = sum(data.count(digit) for digit in "0123456789")
+    alphanumeric = sum(
+        data.count(character) for character in constants.ALPHA_TABLE)
+    others = len(data) - alphanumeric
+    alphanumeric -= digits
+    return 4 + (20 * digits + 33 * alphanumeric + 48 * others) // 6
+
+
+def single_segment(data):
+    """ Returns the mode if a single segment is known to be optimal
+
+    Switching modes costs at least 12 bits of indicators,
+    which short runs of cheaper characters can't make up for.
+    Text of only digits is always a single numeric segment.
+    Text of only alphanumeric characters without 6 digits in a row,
+    and text without kanji, 5 alphanumeric characters in a row
+    or 3 digits in a row, is best encoded as a single segment.
+    Returns None if splitting the data might be cheaper.
+    """
+    if data.isascii() and data.isdigit():
+        return "numeric"
+    if ALPHANUMERIC_TEXT.fullmatch(data):
+        if NUMERIC_RUN.search(data) is None:
+            return "alphanumeric"
+        return None
+    if BINARY_SPLIT.search(data) is not None:
+        return None
+    if not data.isascii():
+        for character in set(data):
+            if not character.isascii() and kanji_value(character) is not None:
+                return None
+    return "binary"
+
+
+def mode_length(data, mode):
+    """ Returns the number of characters of the data in the mode
+
+    For binary this is the number of bytes in the encoding.
+    """
+    if mode == "binary":
+        return len(data.encode(constants.ENCODING))
+    return len(data)
+
+
+def best_segments(data, error_level):
+    """ Picks the segments and the smallest version to fit them
+
+    When a single segment is optimal (see single_segment),
+    the capacity index is used to find the version right away.
+    Otherwise the character count indicator length, which differs between
+    version 1-9, version 10-26 and version 27-40, matters for the split.
+    Ranges of which even the largest version is smaller than the
+    lower bound of minimum_bits are skipped, and ranges after the first
+    that fits the data as a single segment are never needed.
+    For the other ranges the optimal segments are calculated together,
+    and the first version in the first range with enough capacity is used.
+    Returns the segments, the version and the total number of bits.
+    When the data doesn't fit any version,
+    a RuntimeError informs the user of this.
+    """
+    mode = single_segment(data)
+    if mode is not None:
+        length = mode_length(data, mode)
+        found = version(mode, length, error_level)
+        return [[mode, data]], found, total_bits(found, mode, length)
+    capacities = BIT_CAPACITIES[error_level]
+    lower = minimum_bits(data)
+    mode = best_mode(data)
+    length = mode_length(data, mode)
+    ranges = []
+    for first_version, last_version in VERSION_RANGES:
+        if capacities[last_version - 1] < lower:
+            continue
+        ranges.append([first_version, last_version])
+        single = total_bits(first_version, mode, length)
+        if single <= capacities[last_version - 1]:
+            break
+    results = optimal_range_segments(
+        data, [first_version for first_version, _ in ranges])
+    for (first_version, last_version), (segments, bits) in zip(
+            ranges, results):
+        index = bisect.bisect_left(
+            capacities, bits, first_version - 1, last_version)
+        if index < last_version:
+            return segments, index + 1, bits
+    raise data_too_big(error_level)
 
 
 def character_count_indicator_length(mode, version):
@@ -113,17 +477,301 @@ def width(version):
     return 17 + 4 * version
 
 
-def character_count_indicator(mode, number_of_characters, version):
-    """ Generates the character count indicator
+def character_count_indicator(bits, mode, number_of_characters, version):
+    """ Adds the character count indicator
 
     First the desired length is set,
-    which will be used in the formatter string.
-    Lastly the formatter string is filled with the character count.
+    which decides how many bits the indicator will take.
+    Lastly the character count is written to the bit buffer.
     """
     desired_length = character_count_indicator_length(mode, version)
-    formatter = "{{:0{}b}}".format(desired_length)
-    indicator = formatter.format(number_of_characters)
-    return indicator
+    bits.append(number_of_characters, desired_length)
+
+
+def pack_rows(matrix):
+    """ Packs a list of rows into a tuple of ints
+
+    Each row becomes an int with a bit per module,
+    with the first module of the row as the most significant bit.
+    Modules that are None or 0 are packed as 0, others as 1.
+    """
+    return tuple(
+        int("".join("1" if module else "0" for module in row), 2)
+        for row in matrix)
+
+
+def pack_modules(modules, width):
+    """ Packs a bytes-like object of width * width modules into row ints
+
+    Each module is stored as a 0 or 1 byte, row by row.
+    """
+    rows = []
+    for start in range(0, width * width, width):
+        rows.append(int(modules[start:start+width].translate(CHARS_TABLE), 2))
+    return tuple(rows)
+
+
+def unpack_modules(rows, width):
+    """ Unpacks the rows to bytes with a 0 or 1 byte per module
+
+    The modules are stored row by row, the reverse of pack_modules.
+    """
+    return "".join(
+        "{:0{}b}".format(row, width) for row in rows).encode().translate(
+            BITS_TABLE)
+
+
+def unpack_rows(rows, width, mask_rows=None):
+    """ Unpacks the rows back to a list of rows, each a list of 0 or 1
+
+    When mask rows are given, only the modules with a set bit in the mask,
+    will get a value, all other modules will be None.
+    """
+    matrix = []
+    for index, row in enumerate(rows):
+        bits = "{:0{}b}".format(row, width)
+        modules = list(bits.encode().translate(BITS_TABLE))
+        if mask_rows is not None:
+            mask = "{:0{}b}".format(mask_rows[index], width)
+            modules = [
+                module if bit == "1" else None
+                for module, bit in zip(modules, mask)]
+        matrix.append(modules)
+    return matrix
+
+
+def rows_to_bytes(rows, width):
+    """ Packs the bit-packed rows into bytes
+
+    Each row is padded with zero bits to a whole number of bytes,
+    with the left-most module as the most significant bit of the first byte.
+    """
+    row_bytes = (width + 7) // 8
+    padding = row_bytes * 8 - width
+    return b"".join(
+        (row << padding).to_bytes(row_bytes, "big") for row in rows)
+
+
+def rows_from_bytes(data, width):
+    """ Unpacks bytes from rows_to_bytes back to bit-packed rows """
+    row_bytes = (width + 7) // 8
+    padding = row_bytes * 8 - width
+    return tuple(
+        int.from_bytes(data[start:start+row_bytes], "big") >> padding
+        for start in range(0, len(data), row_bytes))
+
+
+def dark_runs(row, width):
+    """ Returns the horizontal runs of dark modules in a bit-packed row
+
+    Each run is a tuple of the x position of the first module and the length.
+    """
+    return [
+        (run.start(), run.end() - run.start())
+        for run in DARK_RUN.finditer("{:0{}b}".format(row, width))]
+
+
+def is_binary_stream(stream):
+    """ Checks if a writable stream expects bytes instead of str
+
+    Streams from the io module are checked by type (like BytesIO),
+    other streams (like sockets from makefile) by the "b" in their mode.
+    """
+    if isinstance(stream, io.TextIOBase):
+        return False
+    if isinstance(stream, (io.RawIOBase, io.BufferedIOBase)):
+        return True
+    return "b" in getattr(stream, "mode", "")
+
+
+def write_output(target, chunks, extension, binary=None):
+    """ Writes the chunks of an output to the target
+
+    The chunks are all str or all bytes, and are written with writelines.
+    The chunks can also be a generator, in which case binary must be given,
+    so the output is streamed to the target one chunk at the time.
+    The target can be a writable text or binary stream,
+    str chunks are encoded as utf-8 for binary streams.
+    Any other target is used as a filename, which gets the extension,
+    if it doesn't end with it already.
+    If the target is None, the output is returned as str or bytes instead.
+    """
+    if binary is None:
+        binary = bool(chunks) and isinstance(chunks[0], bytes)
+    if target is None:
+        return b"".join(chunks) if binary else "".join(chunks)
+    if hasattr(target, "write"):
+        if not binary and is_binary_stream(target):
+            chunks = (chunk.encode("utf-8") for chunk in chunks)
+        elif binary and not is_binary_stream(target):
+            raise ValueError(
+                "Output of {} is binary, use a binary stream".format(
+                    extension))
+        target.writelines(chunks)
+        return None
+    filename = os.fspath(target).rstrip()
+    if not filename.endswith(".{}".format(extension)):
+        filename = "{}.{}".format(filename, extension)
+    if binary:
+        with open(filename, "wb") as f:
+            f.writelines(chunks)
+    else:
+        with open(filename, "w", encoding="utf-8") as f:
+            f.writelines(chunks)
+    return None
+
+
+def color_rgb(color):
+    """ Returns the red, green and blue values of a color as a tuple
+
+    The color is a name from constants.COLORS or a hex color (#abc or #aabbcc).
+    """
+    if color.lower() in constants.COLORS:
+        return constants.COLORS[color.lower()]
+    hex_digits = color[1:]
+    if len(hex_digits) == 3:
+        hex_digits = "".join(digit * 2 for digit in hex_digits)
+    try:
+        if not color.startswith("#") or len(hex_digits) != 6:
+            raise ValueError
+        return tuple(bytes.fromhex(hex_digits))
+    except ValueError:
+        raise ValueError(
+            "Invalid color '{}', use a hex color (#aabbcc) or one of: {}"
+            .format(color, ", ".join(constants.COLORS))) from None
+
+
+def png_chunk(chunk_type, data):
+    """ Returns a png chunk: the length, type, data and crc of the chunk """
+    return b"".join([
+        struct.pack(">I", len(data)), chunk_type, data,
+        struct.pack(">I", zlib.crc32(chunk_type + data))])
+
+
+def scaled_row(row, width, scale, border):
+    """ Returns a row as a png scanline of 1 bit per pixel
+
+    Each module is repeated scale times, with border light modules
+    on both sides, and the scanline is padded to a whole number of bytes.
+    The first byte of the scanline is the filter type (0, none).
+    """
+    pixels = (width + 2 * border) * scale
+    row_bytes = (pixels + 7) // 8
+    bits = "{:0{}b}".format(row << border, width + 2 * border)
+    bits = bits.translate({48: "0" * scale, 49: "1" * scale})
+    return bytes(1) + (int(bits, 2) << (row_bytes * 8 - pixels)).to_bytes(
+        row_bytes, "big")
+
+
+def transpose(rows, width):
+    """ Transposes bit-packed rows into bit-packed columns
+
+    The columns use the same layout as the rows,
+    with the top module as the most significant bit.
+    """
+    lines = ["{:0{}b}".format(row, width) for row in rows]
+    return tuple(int("".join(column), 2) for column in zip(*lines))
+
+
+def board(rows, width):
+    """ Combines bit-packed rows into a single int
+
+    Each row is followed by a single zero bit (the guard),
+    so that shifting the board by one bit never mixes two rows.
+    Shifting by the width plus one moves to the same module of a next row.
+    This allows checking every row of the matrix with a few operations,
+    instead of looping over all the modules.
+    """
+    return int("".join("{:0{}b}0".format(row, width) for row in rows), 2)
+
+
+def boards(rows, width):
+    """ Returns the board of the rows and the board of the columns """
+    return board(rows, width), board(transpose(rows, width), width)
+
+
+def count_bits(value):
+    """ Counts the number of set bits in an int """
+    return bin(value).count("1")
+
+
+def line_penalty(dark, light, stride, finder=True):
+    """ Calculates the penalty for the lines of a board
+
+    For both the dark and the light modules,
+    the following penalty rules are checked using shifted boards:
+    - Single line with same colored bits
+        This gives a penalty for each group of 5 or more.
+        The penalty is 3 for a group of 5,
+        and 1 more for every next same colored bit.
+        Each group has a bit set for the first 5 bits of it,
+        for every extra bit of the group there is an extra bit set.
+    - 2x2 area of same colored bits
+        This gives a penalty for ALL 2x2 groups,
+        even if they are part of another group.
+        Every 2x2 square has a penalty of 3.
+        This is only needed for the rows, as the result is the same.
+    - Similar bits to a finder pattern (unless finder is False)
+        This gives a penalty for all 10111010000 or 00001011101.
+        Each time these bits are found, add 40 to the penalty.
+        All 11 bits are matched at once, using the shifted boards.
+    The stride is the width plus one if the 2x2 areas should be counted,
+    otherwise it is 0.
+    """
+    score = 0
+    for same in [dark, light]:
+        groups = same & same >> 1 & same >> 2 & same >> 3 & same >> 4
+        score += count_bits(groups) + 2 * count_bits(groups & ~(groups >> 1))
+        if stride:
+            squares = same & same >> 1 & same >> stride & same >> stride + 1
+            score += 3 * count_bits(squares)
+    if not finder:
+        return score
+    for pattern in ["10111010000", "00001011101"]:
+        found = -1
+        for shift, bit in enumerate(pattern):
+            if bit == "1":
+                found &= dark >> shift
+            else:
+                found &= light >> shift
+        score += 40 * count_bits(found)
+    return score
+
+
+def penalty(rows, columns, valid, width, limit=None):
+    """ Calculates the penalty score of a masked matrix
+
+    The rows and columns are boards (see board) of the matrix,
+    and the valid board has a bit set for each module (so no guards).
+    First there is a penalty for a large amount of dark or light bits:
+    If the percentage of dark modules is not near 50,
+    add a penalty of 10 for every 5 percent (rounded down).
+    This means, 4.9 percent results in 0, but 5.0 in 10.
+    After that, lines with the same color, 2x2 squares and
+    finder-like patterns are checked for the rows by line_penalty,
+    followed by the columns.
+    When the columns are None, only the rows are checked,
+    and the finder-like patterns are skipped (to quickly get an estimate).
+    When a limit is given, None is returned as soon as the score
+    reaches the limit, as the mask can't be better than that.
+    """
+    score = 0
+    percentage = (count_bits(rows) / (width * width)) * 100
+    if percentage > 50:
+        score += int((percentage - 50) / 5) * 10
+    elif percentage < 50:
+        score += int((50 - percentage) / 5) * 10
+    if limit is not None and score >= limit:
+        return None
+    score += line_penalty(rows, valid ^ rows, width + 1, columns is not None)
+    if columns is None:
+        return score
+    if limit is not None and score >= limit:
+        return None
+    score += line_penalty(columns, valid ^ columns, 0)
+    if limit is not None and score >= limit:
+        return None
+    return score
 
 
 def interleave_codewords(data_blocks, error_blocks):
@@ -141,17 +789,17 @@ def interleave_codewords(data_blocks, error_blocks):
     The error blocks will be added after all data blocks.
     """
     biggest_block = len(max(data_blocks, key=len))
-    output = ""
+    output = bytearray()
     for i in range(0, biggest_block):
         for block in data_blocks:
             if i < len(block):
-                output += block[i]
+                output.append(block[i])
     biggest_block = len(max(error_blocks, key=len))
     for i in range(0, biggest_block):
         for block in error_blocks:
             if i < len(block):
-                output += block[i]
-    return output
+                output.append(block[i])
+    return bytes(output)
 
 
 def add_format_info(matrix, width, format_string):
@@ -190,25 +838,20 @@ def generate_blocks(codewords, info):
 
     All the codewords are be placed into blocks,
     and the error blocks are generated from them.
+    The codewords are bytes, so each block is a memoryview slice of them.
     """
+    codewords = memoryview(codewords)
     data_blocks = []
     error_blocks = []
-    block_index = 0
     word_index = 0
-    for block in range(0, info[1]):
-        data_blocks.append([])
-        for _ in range(0, info[2]):
-            data_blocks[block_index].append(codewords[word_index])
-            word_index += 1
-        error_blocks.append(new_error_block(data_blocks[block_index], info))
-        block_index += 1
-    for block in range(0, info[3]):
-        data_blocks.append([])
-        for _ in range(0, info[4]):
-            data_blocks[block_index].append(codewords[word_index])
-            word_index += 1
-        error_blocks.append(new_error_block(data_blocks[block_index], info))
-        block_index += 1
+    for _ in range(0, info[1]):
+        data_blocks.append(codewords[word_index:word_index+info[2]])
+        word_index += info[2]
+        error_blocks.append(new_error_block(data_blocks[-1], info))
+    for _ in range(0, info[3]):
+        data_blocks.append(codewords[word_index:word_index+info[4]])
+        word_index += info[4]
+        error_blocks.append(new_error_block(data_blocks[-1], info))
     return data_blocks, error_blocks
 
 
@@ -219,26 +862,76 @@ def new_error_block(data_block, info):
     according to the Reed-Solomon error correction.
     The process itself is very complicated,
     and more information on it can be found online.
+    The remainder of the polynomial division is kept as a single int,
+    so every data byte only needs a shift, a lookup and a xor,
+    using the multiplication table from error_correction_table.
+    The data block can be any bytes-like object, bytes are returned.
     """
-    block = data_block[:]
-    for item in block:
-        block[block.index(item)] = int(item, 2)
-    block.extend([0] * (info[0]))
-    gen_result = [0] * len(constants.POLYNOMIALS[info[0]])
-    for i in data_block:
-        coefficient = block.pop(0)
-        if coefficient == 0:
-            continue
-        alpha_exp = constants.GALOIS_INV[coefficient]
-        for n in range(len(constants.POLYNOMIALS[info[0]])):
-            gen_result[n] = alpha_exp + constants.POLYNOMIALS[info[0]][n]
-            gen_result[n] = constants.GALOIS[gen_result[n] % 255]
-            block[n] = gen_result[n] ^ block[n]
-    if len(block) < len(data_block):
-        block.extend([0] * (len(data_block) - len(block)))
-    for item in block:
-        block[block.index(item)] = "{:08b}".format(item)
-    return block
+    length = info[0]
+    table = error_correction_table(length)
+    shift = 8 * (length - 1)
+    mask = (1 << 8 * length) - 1
+    remainder = 0
+    for byte in data_block:
+        coefficient = (remainder >> shift) ^ byte
+        remainder = ((remainder << 8) & mask) ^ table[coefficient]
+    return remainder.to_bytes(length, "big")
+
+
+def error_correction_table(length):
+    """ Returns the multiplication table for a generator polynomial
+
+    For each possible byte value, the generator polynomial is multiplied
+    by the value in the Galois field, using the stored log values.
+    The resulting coefficients are stored as a single int,
+    with the highest degree in the most significant byte.
+    The tables are generated once per polynomial and cached.
+    """
+    table = ERROR_CORRECTION_TABLES.get(length)
+    if table is None:
+        table = [0]
+        for value in range(1, 256):
+            alpha_exp = constants.GALOIS_INV[value]
+            row = 0
+            for exponent in constants.POLYNOMIALS[length]:
+                row <<= 8
+                row |= constants.GALOIS[(alpha_exp + exponent) % 255]
+            table.append(row)
+        ERROR_CORRECTION_TABLES[length] = table
+    return table
+
+
+def encode_segments(segments, version):
+    """ Encodes the segments of the input for the version
+
+    Each segment starts with the mode indicator and character count
+    indicator, followed by the data of the segment, encoded by the mode.
+    Returns the data bits as a BitBuffer.
+    """
+    out = BitBuffer()
+    for mode, text in segments:
+        if mode == "binary" and isinstance(text, str):
+            text = text.encode(constants.ENCODING)
+        out.append(int(constants.MODES[mode]["mode_indicator"], 2), 4)
+        character_count_indicator(out, mode, len(text), version)
+        if mode == "numeric":
+            for i in range(0, len(text), 3):
+                group = text[i:i+3]
+                out.append(int(group), 3 * len(group) + 1)
+        if mode == "alphanumeric":
+            alpha_codes = [constants.ALPHA_TABLE[c] for c in text]
+            for i in range(0, len(alpha_codes), 2):
+                if i + 1 < len(alpha_codes):
+                    number = alpha_codes[i] * 45 + alpha_codes[i + 1]
+                    out.append(number, 11)
+                else:
+                    out.append(alpha_codes[i], 6)
+        if mode == "binary":
+            out.extend(text)
+        if mode == "kanji":
+            for value in kanji_values(text):
+                out.append(value, 13)
+    return out
 
 
 def pad_zeros(data, max_bytes):
@@ -253,17 +946,74 @@ def pad_zeros(data, max_bytes):
     When there is still space left,
     the "no data" pattern is added:
     (11101100 and 00010001 alternated)
+    The data is a BitBuffer, which is padded in place and returned.
     """
     spare_bits = max_bytes - len(data)
-    if spare_bits > 4:
-        data += "0" * 4
-    else:
-        data += "0" * spare_bits
+    data.append(0, min(spare_bits, 4))
     if len(data) % 8 != 0:
-        pad_to_eight_number = 8 - len(data) % 8
-        data += "0" * pad_to_eight_number
-    while len(data) < max_bytes:
-        data += "11101100"
-        if len(data) < max_bytes:
-            data += "00010001"
+        data.append(0, 8 - len(data) % 8)
+    spare_bytes = (max_bytes - len(data)) // 8
+    data.extend((b"\xec\x11" * (spare_bytes // 2 + 1))[:spare_bytes])
     return data
+
+
+# Reed-Solomon multiplication tables per generator polynomial,
+# filled by error_correction_table when a polynomial is first used
+ERROR_CORRECTION_TABLES = {}
+
+# Static matrix per version (finder, alignment, timer and version patterns),
+# stored as bit-packed function and pattern rows by generate_static_matrix
+STATIC_TEMPLATES = {}
+
+# Versions that share the same character count indicator lengths
+VERSION_RANGES = [[1, 9], [10, 26], [27, 40]]
+
+# Patterns for text that might be cheaper as more than one segment,
+# see single_segment for the reasoning behind the lengths
+ALPHANUMERIC_TEXT = re.compile("[{}]*".format(
+    re.escape("".join(constants.ALPHA_TABLE))))
+NUMERIC_RUN = re.compile("[0-9]{6}")
+BINARY_SPLIT = re.compile("[0-9]{{3}}|[{}]{{5}}".format(
+    re.escape("".join(constants.ALPHA_TABLE))))
+
+# Pattern to find the runs of dark modules in a row formatted as 0 and 1
+DARK_RUN = re.compile("1+")
+
+# Translation tables between the characters "0" and "1" and the bytes 0 and 1
+BITS_TABLE = bytes.maketrans(b"01", bytes([0, 1]))
+CHARS_TABLE = bytes.maketrans(bytes([0, 1]), b"01")
+
+# Positions of the data bits per version in placement order,
+# stored as a tuple of y * width + x by QRCode.generate_data_positions
+DATA_POSITIONS = {}
+
+# Mask patterns, applied to the data modules where the result is True
+MASK_PATTERNS = [
+    lambda x, y: (x + y) % 2 == 0,
+    lambda x, y: y % 2 == 0,
+    lambda x, y: x % 3 == 0,
+    lambda x, y: (x + y) % 3 == 0,
+    lambda x, y: (int(y / 2) + int(x / 3)) % 2 == 0,
+    lambda x, y: (x * y) % 2 + (x * y) % 3 == 0,
+    lambda x, y: ((x * y) % 3 + x * y) % 2 == 0,
+    lambda x, y: ((x * y) % 3 + x + y) % 2 == 0
+]
+
+# Masks per version, along with the boards needed to score them,
+# stored as a dict by QRCode.generate_mask_templates
+MASK_TEMPLATES = {}
+
+# Format information rows and boards per version and error level,
+# stored as a list (one per mask) by QRCode.generate_format_templates
+FORMAT_TEMPLATES = {}
+
+# Capacity index, sorted by version (the list index is the version minus 1)
+# Bits per error level, and characters per mode and error level
+BIT_CAPACITIES = {
+    level: [constants.VERSIONS[i][level] for i in range(1, 41)]
+    for level in "LMQH"}
+CHARACTER_CAPACITIES = {
+    mode: {
+        level: [character_capacity(i, mode, level) for i in range(1, 41)]
+        for level in "LMQH"}
+    for mode in constants.MODES}
@@ -6,6 +6,8 @@ print(code.version)  # you can access a lot of extra info about the qr
 print(code.mode)  # including the encoding mode used
 print(code.err_lvl)
 print(code.matrix)  # and the data matrix itself
+print(code.rows)  # or as compact bit-packed rows (one int per row)
+print(code.module(0, 0))  # or a single module (1 is dark, 0 is light)
 # lastly output the qr to the terminal
 code.out_terminal()
 
@@ -35,9 +37,11 @@ code.out_svg(
     light="#ccccff",
     background="orange")
 
-# binary encoding with 15% data recovery (M, default)
+# mixed encoding with 15% data recovery (M, default)
 code = QRCode(
     "こんにちは, if you mix kanji with other alphabets or unsupported characters, "
-    "it will encode the string as binary data.")
+    "it will split the string in segments with different encoding modes.")
+print(code.mode)  # mixed
+print(code.segments)  # a list of the modes and the text for each segment
 code.out_terminal()
 code.out_svg("binary.svg")